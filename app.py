@@ -1,10 +1,10 @@
 import streamlit as st
 import os
+import io
 import sys
 import cv2
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
 import pandas as pd
 import json
 import torch
@@ -22,9 +22,11 @@ except Exception as e:
     CANVAS_AVAILABLE = False
 
 from utils.grounding_dino import GroundingDINOPredictor
-from utils.annotation_utils import save_annotations, load_annotations
-from utils.visualization import draw_boxes_on_image
+from utils.annotation_utils import detections_to_annotations, save_annotations, load_annotations
+from utils.visualization import draw_boxes, image_to_array
 from utils.editor import AnnotationEditor
+from utils._kernels import clip_rects
+from utils.image_utils import list_image_files
 
 # Set page configuration
 st.set_page_config(page_title="Annotation Tool", layout="wide")
@@ -50,15 +52,30 @@ if 'current_label' not in st.session_state:
     st.session_state.current_label = ""
 if 'editing_annotation_index' not in st.session_state:
     st.session_state.editing_annotation_index = None
+if 'uploaded_blobs' not in st.session_state:
+    st.session_state.uploaded_blobs = {}
+if 'image_sizes' not in st.session_state:
+    st.session_state.image_sizes = {}
+
+# Uploaded images are kept in memory under paths with this prefix instead of being written to disk
+MEMORY_PREFIX = "memory://"
+
+# Load the Grounding DINO predictor once and keep it resident across reruns; only the most
+# recent configuration is kept, so switching precision does not hold two models in memory
+@st.cache_resource(max_entries=1)
+def get_predictor(half_weights=False):
+    return GroundingDINOPredictor(half_weights=half_weights)
 
 # Function to load images from a directory
 def load_images_from_dir(directory):
-    valid_extensions = [".jpg", ".jpeg", ".png", ".bmp"]
-    image_files = []
-    for file in os.listdir(directory):
-        if any(file.lower().endswith(ext) for ext in valid_extensions):
-            image_files.append(os.path.join(directory, file))
-    return sorted(image_files)
+    return list_image_files(directory)
+
+# Render an image with its annotations, cached per (image path, annotations) so unrelated
+# reruns reuse the drawn array; the underscore-prefixed image argument is not hashed
+@st.cache_data(max_entries=8)
+def render_annotated_image(image_path, annotations_key, _image):
+    bboxes, labels, scores = zip(*annotations_key)
+    return draw_boxes(image_to_array(_image), np.asarray(bboxes, dtype=np.int32), labels, scores)
 
 # Function to display the current image with annotations
 def display_current_image():
@@ -66,30 +83,29 @@ def display_current_image():
         # Get annotations for the current image if they exist
         annotations = st.session_state.annotations.get(st.session_state.current_image_path, [])
         
-        # Convert PIL Image to numpy array
-        img = np.array(st.session_state.current_image)
-        
         # Display the image with annotations
         if annotations:
-            img = draw_boxes_on_image(img, annotations)
+            annotations_key = tuple((tuple(ann["bbox"]), ann["label"], ann["score"]) for ann in annotations)
+            img = render_annotated_image(st.session_state.current_image_path, annotations_key, st.session_state.current_image)
+        else:
+            img = image_to_array(st.session_state.current_image)
         
         # Display the image
         st.image(img, caption=f"Image: {os.path.basename(st.session_state.current_image_path)}", use_column_width=True)
         
         # Display annotation information in a table
         if annotations:
-            # Create a DataFrame with annotations
-            annotation_df = pd.DataFrame([
-                {
-                    "Index": i,
-                    "Label": ann["label"],
-                    "Score": ann["score"],
-                    "X1": ann["bbox"][0],
-                    "Y1": ann["bbox"][1],
-                    "X2": ann["bbox"][2],
-                    "Y2": ann["bbox"][3]
-                } for i, ann in enumerate(annotations)
-            ])
+            # Create a DataFrame with annotations from column arrays
+            bboxes = np.asarray([ann["bbox"] for ann in annotations])
+            annotation_df = pd.DataFrame({
+                "Index": np.arange(len(annotations)),
+                "Label": [ann["label"] for ann in annotations],
+                "Score": [ann["score"] for ann in annotations],
+                "X1": bboxes[:, 0],
+                "Y1": bboxes[:, 1],
+                "X2": bboxes[:, 2],
+                "Y2": bboxes[:, 3]
+            })
             st.dataframe(annotation_df, use_container_width=True)
 
 # Function to navigate to the next image
@@ -109,46 +125,38 @@ def process_canvas_objects(objects, img_width, img_height):
     # Get current annotations
     annotations = st.session_state.annotations.get(st.session_state.current_image_path, [])
     
-    # Process each object from the canvas
-    for obj in objects:
-        # Check if this is a rectangle
-        if obj.get("type") == "rect":
-            # Get the object properties
-            left = obj.get("left", 0)
-            top = obj.get("top", 0)
-            width = obj.get("width", 0)
-            height = obj.get("height", 0)
-            scaleX = obj.get("scaleX", 1)
-            scaleY = obj.get("scaleY", 1)
-            
-            # Calculate actual dimensions after scaling
-            actual_width = width * scaleX
-            actual_height = height * scaleY
-            
-            # Calculate bounding box coordinates
-            x1 = max(0, int(left))
-            y1 = max(0, int(top))
-            x2 = min(img_width, int(left + actual_width))
-            y2 = min(img_height, int(top + actual_height))
-            
-            # If we're editing an existing annotation
-            if st.session_state.editing_annotation_index is not None:
-                # Update the existing annotation
-                if 0 <= st.session_state.editing_annotation_index < len(annotations):
-                    annotations[st.session_state.editing_annotation_index]["bbox"] = [x1, y1, x2, y2]
-            else:
-                # This is a new annotation
-                if st.session_state.current_label:
-                    # Create a new annotation
-                    new_annotation = {
-                        "bbox": [x1, y1, x2, y2],
-                        "score": 1.0,  # Manual annotations get a score of 1.0
-                        "label": st.session_state.current_label
-                    }
-                    annotations.append(new_annotation)
-                    
-                    # Reset current label after adding
-                    st.session_state.current_label = ""
+    # Collect rectangle geometry from the canvas objects and clip all boxes in one call
+    rects = [obj for obj in objects if obj.get("type") == "rect"]
+    geometry = np.array([
+        [obj.get("left", 0), obj.get("top", 0), obj.get("width", 0), obj.get("height", 0),
+         obj.get("scaleX", 1), obj.get("scaleY", 1)]
+        for obj in rects
+    ], dtype=np.float64).reshape(-1, 6)
+    boxes = clip_rects(
+        geometry[:, 0], geometry[:, 1], geometry[:, 2], geometry[:, 3], geometry[:, 4], geometry[:, 5],
+        int(img_width), int(img_height)
+    )
+    
+    # Process each rectangle from the canvas
+    for x1, y1, x2, y2 in boxes.tolist():
+        # If we're editing an existing annotation
+        if st.session_state.editing_annotation_index is not None:
+            # Update the existing annotation
+            if 0 <= st.session_state.editing_annotation_index < len(annotations):
+                annotations[st.session_state.editing_annotation_index]["bbox"] = [x1, y1, x2, y2]
+        else:
+            # This is a new annotation
+            if st.session_state.current_label:
+                # Create a new annotation
+                new_annotation = {
+                    "bbox": [x1, y1, x2, y2],
+                    "score": 1.0,  # Manual annotations get a score of 1.0
+                    "label": st.session_state.current_label
+                }
+                annotations.append(new_annotation)
+                
+                # Reset current label after adding
+                st.session_state.current_label = ""
     
     # Update annotations in session state
     st.session_state.annotations[st.session_state.current_image_path] = annotations
@@ -157,135 +165,52 @@ def process_canvas_objects(objects, img_width, img_height):
     if st.session_state.editor:
         st.session_state.editor.set_annotations(annotations)
 
+# Function to open an image from disk or from the in-memory uploads
+def open_image(image_path):
+    if image_path.startswith(MEMORY_PREFIX):
+        return Image.open(io.BytesIO(st.session_state.uploaded_blobs[image_path]))
+    return Image.open(image_path)
+
+# Function to get the paths images are exported under; uploads keep only their original file name,
+# so the session-specific memory://<file_id>/ prefix never ends up in the dataset, unless another
+# image already took that name, in which case the file_id is kept as a suffix to stay unique
+def export_image_paths(image_paths):
+    export_paths = {}
+    used = set()
+    for image_path in image_paths:
+        export_path = image_path
+        if image_path.startswith(MEMORY_PREFIX):
+            file_id, export_path = image_path[len(MEMORY_PREFIX):].split("/", 1)
+            if export_path in used:
+                stem, ext = os.path.splitext(export_path)
+                export_path = f"{stem}_{file_id}{ext}"
+        used.add(export_path)
+        export_paths[image_path] = export_path
+    return export_paths
+
 # Function to load the current image based on the index
 def load_current_image():
     if st.session_state.image_files and 0 <= st.session_state.current_index < len(st.session_state.image_files):
         image_path = st.session_state.image_files[st.session_state.current_index]
         st.session_state.current_image_path = image_path
-        st.session_state.current_image = Image.open(image_path)
+        st.session_state.current_image = open_image(image_path)
+        st.session_state.image_sizes[image_path] = st.session_state.current_image.size
         
         # Reset edit mode when loading a new image
         st.session_state.edit_mode = False
         st.session_state.editing_annotation_index = None
         st.session_state.current_label = ""
         
-        # Initialize the editor for this image if it doesn't exist
-        if st.session_state.editor is None or st.session_state.editor.image_path != image_path:
+        # Create the editor once, then point it at each new image
+        if st.session_state.editor is None:
             st.session_state.editor = AnnotationEditor(image_path, st.session_state.current_image)
+        elif st.session_state.editor.image_path != image_path:
+            st.session_state.editor.load(image_path, st.session_state.current_image)
 
-# Main application layout
-st.title("Image Annotation Tool with Grounding DINO")
-
-# Sidebar for controls
-with st.sidebar:
-    st.header("Controls")
-    
-    # Image upload section
-    st.subheader("Upload Images")
-    uploaded_files = st.file_uploader("Choose images", accept_multiple_files=True, type=["jpg", "jpeg", "png", "bmp"])
-    
-    # Directory selection
-    st.subheader("Or Select Directory")
-    dir_path = st.text_input("Enter directory path")
-    if st.button("Load Directory") and dir_path and os.path.isdir(dir_path):
-        st.session_state.image_files = load_images_from_dir(dir_path)
-        if st.session_state.image_files:
-            st.session_state.current_index = 0
-            load_current_image()
-            st.success(f"Loaded {len(st.session_state.image_files)} images from directory")
-        else:
-            st.error("No images found in the specified directory")
-    
-    # Process uploaded files
-    if uploaded_files:
-        temp_dir = "temp_uploads"
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Save uploaded files to temp directory
-        st.session_state.image_files = []
-        for uploaded_file in uploaded_files:
-            file_path = os.path.join(temp_dir, uploaded_file.name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            st.session_state.image_files.append(file_path)
-        
-        if st.session_state.image_files:
-            st.session_state.current_index = 0
-            load_current_image()
-            st.success(f"Loaded {len(uploaded_files)} images")
-    
-    # Pre-annotation section
-    st.subheader("Pre-annotation")
-    text_prompt = st.text_input("Enter objects to detect (comma-separated)", "person, car, dog, cat")
-    box_threshold = st.slider("Box Threshold", 0.1, 0.9, 0.35, 0.05)
-    text_threshold = st.slider("Text Threshold", 0.1, 0.9, 0.25, 0.05)
-    
-    if st.button("Run Pre-annotation") and st.session_state.current_image is not None:
-        with st.spinner("Running Grounding DINO for pre-annotation..."):
-            try:
-                # Initialize the Grounding DINO predictor
-                predictor = GroundingDINOPredictor()
-                
-                # Run prediction on the current image
-                boxes, scores, labels = predictor.predict_image(
-                    st.session_state.current_image,
-                    text_prompt,
-                    box_threshold=box_threshold,
-                    text_threshold=text_threshold
-                )
-                
-                # Convert to list of dictionaries for easier handling
-                annotations = []
-                for box, score, label in zip(boxes, scores, labels):
-                    annotations.append({
-                        "bbox": box.tolist(),  # [x1, y1, x2, y2]
-                        "score": float(score),
-                        "label": label
-                    })
-                
-                # Store annotations for the current image
-                st.session_state.annotations[st.session_state.current_image_path] = annotations
-                
-                # Update the editor with new annotations
-                if st.session_state.editor:
-                    st.session_state.editor.set_annotations(annotations)
-                
-                st.success(f"Found {len(annotations)} objects")
-            except Exception as e:
-                st.error(f"Error during pre-annotation: {str(e)}")
-    
-    # Export annotations
-    st.subheader("Export Annotations")
-    export_format = st.selectbox("Export Format", ["COCO", "PASCAL VOC"])
-    export_path = st.text_input("Export Directory")
-    
-    if st.button("Export Annotations") and export_path:
-        try:
-            os.makedirs(export_path, exist_ok=True)
-            save_annotations(st.session_state.annotations, export_format, export_path)
-            st.success(f"Annotations exported to {export_path}")
-        except Exception as e:
-            st.error(f"Error exporting annotations: {str(e)}")
-    
-    # Navigation buttons
-    st.subheader("Navigation")
-    col1, col2 = st.columns(2)
-    with col1:
-        if st.button("Previous"):
-            prev_image()
-    with col2:
-        if st.button("Next"):
-            next_image()
-
-# Main content area
-if st.session_state.current_image is None:
-    st.info("Please upload images or select a directory to start annotation")
-else:
-    # Display the current image with annotations
-    
-    # Display the current image with annotations
-    display_current_image()
-    
+# Manual annotation editing panel; st.fragment reruns only this function when its own widgets
+# change, and st.rerun() from inside it still reruns the whole page after an edit
+@st.fragment
+def edit_panel():
     # Manual annotation editing section
     st.subheader("Manual Annotation Editing")
     
@@ -317,7 +242,7 @@ else:
                 if st.button("Edit Selected"):
                     st.session_state.editing_annotation_index = selected_idx
                     # Convert annotation to canvas object
-                    st.experimental_rerun()
+                    st.rerun()
             
             with col2:
                 if st.button("Delete Selected"):
@@ -326,12 +251,12 @@ else:
                     if st.session_state.editor:
                         st.session_state.editor.set_annotations(annotations)
                     st.session_state.editing_annotation_index = None
-                    st.experimental_rerun()
+                    st.rerun()
             
             with col3:
                 if st.session_state.editing_annotation_index is not None and st.button("Finish Editing"):
                     st.session_state.editing_annotation_index = None
-                    st.experimental_rerun()
+                    st.rerun()
     else:
         # Traditional form-based annotation editing
         
@@ -365,7 +290,7 @@ else:
                     st.session_state.editor.set_annotations(current_annotations)
                 
                 st.success(f"Added annotation for {new_label}")
-                st.experimental_rerun()
+                st.rerun()
         
         # Edit or delete existing annotations
         with st.expander("Edit/Delete Annotations"):
@@ -405,7 +330,7 @@ else:
                             st.session_state.editor.set_annotations(annotations)
                         
                         st.success("Annotation updated")
-                        st.experimental_rerun()
+                        st.rerun()
                 
                 with col2:
                     if st.button("Delete Annotation"):
@@ -419,7 +344,123 @@ else:
                             st.session_state.editor.set_annotations(annotations)
                         
                         st.success("Annotation deleted")
-                        st.experimental_rerun()
+                        st.rerun()
+
+# Main application layout
+st.title("Image Annotation Tool with Grounding DINO")
+
+# Sidebar for controls
+with st.sidebar:
+    st.header("Controls")
+    
+    # Image upload section
+    st.subheader("Upload Images")
+    uploaded_files = st.file_uploader("Choose images", accept_multiple_files=True, type=["jpg", "jpeg", "png", "bmp"])
+    
+    # Directory selection
+    st.subheader("Or Select Directory")
+    dir_path = st.text_input("Enter directory path")
+    if st.button("Load Directory") and dir_path and os.path.isdir(dir_path):
+        st.session_state.image_files = load_images_from_dir(dir_path)
+        if st.session_state.image_files:
+            st.session_state.current_index = 0
+            load_current_image()
+            st.success(f"Loaded {len(st.session_state.image_files)} images from directory")
+        else:
+            st.error("No images found in the specified directory")
+    
+    # Process uploaded files, keeping their bytes in memory; the file ID makes each path unique
+    # across sessions, and the uploads are only reloaded when the selection changes
+    if uploaded_files:
+        upload_paths = [f"{MEMORY_PREFIX}{uploaded_file.file_id}/{uploaded_file.name}" for uploaded_file in uploaded_files]
+        
+        if upload_paths != list(st.session_state.uploaded_blobs):
+            st.session_state.uploaded_blobs = {
+                path: uploaded_file.getvalue() for path, uploaded_file in zip(upload_paths, uploaded_files)
+            }
+            st.session_state.image_files = upload_paths
+            
+            st.session_state.current_index = 0
+            load_current_image()
+            st.success(f"Loaded {len(uploaded_files)} images")
+    
+    # Pre-annotation section
+    st.subheader("Pre-annotation")
+    text_prompt = st.text_input("Enter objects to detect (comma-separated)", "person, car, dog, cat")
+    box_threshold = st.slider("Box Threshold", 0.1, 0.9, 0.35, 0.05)
+    text_threshold = st.slider("Text Threshold", 0.1, 0.9, 0.25, 0.05)
+    half_weights = st.checkbox("Half precision weights", help="Load half precision weights on CUDA, kept only if they match FP32")
+    
+    if st.button("Run Pre-annotation") and st.session_state.current_image is not None:
+        with st.spinner("Running Grounding DINO for pre-annotation..."):
+            try:
+                # Get the cached Grounding DINO predictor
+                predictor = get_predictor(half_weights)
+                
+                # Run prediction on the current image
+                boxes, scores, labels = predictor.predict_image(
+                    st.session_state.current_image,
+                    text_prompt,
+                    box_threshold=box_threshold,
+                    text_threshold=text_threshold
+                )
+                
+                # Convert to list of dictionaries
+                annotations, _, _ = detections_to_annotations(boxes, scores, labels)
+                
+                # Store annotations for the current image
+                st.session_state.annotations[st.session_state.current_image_path] = annotations
+                
+                # Update the editor with new annotations
+                if st.session_state.editor:
+                    st.session_state.editor.set_annotations(annotations)
+                
+                st.success(f"Found {len(annotations)} objects")
+            except Exception as e:
+                st.error(f"Error during pre-annotation: {str(e)}")
+    
+    # Export annotations
+    st.subheader("Export Annotations")
+    export_format = st.selectbox("Export Format", ["COCO", "PASCAL VOC"])
+    export_path = st.text_input("Export Directory")
+    
+    if st.button("Export Annotations") and export_path:
+        try:
+            os.makedirs(export_path, exist_ok=True)
+            
+            # Key annotations and sizes by their export paths
+            export_paths = export_image_paths(st.session_state.annotations)
+            export_annotations = {}
+            export_sizes = {}
+            for image_path, annotations in st.session_state.annotations.items():
+                export_annotations[export_paths[image_path]] = annotations
+                if image_path in st.session_state.image_sizes:
+                    export_sizes[export_paths[image_path]] = st.session_state.image_sizes[image_path]
+            
+            save_annotations(export_annotations, export_format, export_path, export_sizes)
+            st.success(f"Annotations exported to {export_path}")
+        except Exception as e:
+            st.error(f"Error exporting annotations: {str(e)}")
+    
+    # Navigation buttons
+    st.subheader("Navigation")
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Previous"):
+            prev_image()
+    with col2:
+        if st.button("Next"):
+            next_image()
+
+# Main content area
+if st.session_state.current_image is None:
+    st.info("Please upload images or select a directory to start annotation")
+else:
+    # Display the current image with annotations
+    display_current_image()
+    
+    # Manual annotation editing forms
+    edit_panel()
 
 # Display image count and current position
 if st.session_state.image_files:
@@ -1,13 +1,13 @@
 import os
 import argparse
-import torch
-from PIL import Image
-import numpy as np
-import matplotlib.pyplot as plt
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from utils.grounding_dino import GroundingDINOPredictor
-from utils.visualization import draw_boxes_on_image
-from utils.annotation_utils import save_annotations
+from utils.visualization import draw_boxes, image_to_array, save_visualization
+from utils.annotation_utils import detections_to_annotations, save_annotations
+from utils.image_utils import chunked, list_image_files, load_image
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Batch process images with Grounding DINO")
@@ -18,7 +18,155 @@ def parse_args():
     parser.add_argument("--text-threshold", type=float, default=0.25, help="Text threshold")
     parser.add_argument("--format", type=str, default="COCO", choices=["COCO", "PASCAL VOC"], help="Output format")
     parser.add_argument("--visualize", action="store_true", help="Generate visualization images")
-    return parser.parse_args()
+    parser.add_argument("--batch-size", type=int, default=8, help="Number of images per inference batch")
+    parser.add_argument("--onnx", action="store_true", help="Run the ONNX export from download_model.py --onnx with ONNX Runtime")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile on CUDA (recompiles for each new image size)")
+    parser.add_argument("--half-weights", action="store_true", help="Use half precision weights on CUDA if they match FP32")
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    return args
+
+def write_visualization(image, boxes, labels, scores, output_image_path):
+    """
+    Draw detections on an image and save it, reporting rather than raising errors.
+    
+    Args:
+        image (PIL.Image): The source image.
+        boxes (array-like): (N, 4) array of [x1, y1, x2, y2] boxes.
+        labels (list): N object labels.
+        scores (array-like): N confidence scores.
+        output_image_path (str): Path of the visualization to write.
+    """
+    try:
+        img_np = image_to_array(image)
+        img_with_boxes = draw_boxes(img_np, boxes, labels, scores)
+        save_visualization(img_with_boxes, output_image_path)
+    except Exception as e:
+        print(f"Error saving visualization {output_image_path}: {str(e)}")
+
+# Marks the end of a pipeline stage's output on its queue
+END_OF_STREAM = object()
+
+def put_until_stopped(stage_queue, item, stop_event):
+    """
+    Put an item on a bounded queue, giving up if the pipeline is being torn down.
+    
+    Args:
+        stage_queue (queue.Queue): Queue feeding the next stage.
+        item: Item to put on the queue.
+        stop_event (threading.Event): Set when the consumer has stopped reading.
+        
+    Returns:
+        bool: True if the item was queued.
+    """
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def read_batches(batches, decoder, decoded_queue, stop_event):
+    """
+    Pipeline stage A: decode batches of images and queue them for inference.
+    
+    Args:
+        batches (iterable): Iterable of lists of image paths.
+        decoder (ThreadPoolExecutor): Pool used to decode the images of a batch in parallel.
+        decoded_queue (queue.Queue): Receives (paths, images) tuples, then END_OF_STREAM.
+        stop_event (threading.Event): Set when inference has stopped consuming batches.
+    """
+    try:
+        for batch_paths in batches:
+            batch_images = list(decoder.map(load_image, batch_paths))
+            if not put_until_stopped(decoded_queue, (batch_paths, batch_images), stop_event):
+                return
+    finally:
+        put_until_stopped(decoded_queue, END_OF_STREAM, stop_event)
+
+def predict_loaded(predictor, loaded, args, text_cache, failed_paths):
+    """
+    Pipeline stage B: run inference on a batch, retrying its images one at a time if the batch
+    fails, so a single bad image does not drop the whole batch.
+    
+    Args:
+        predictor (GroundingDINOPredictor): The predictor to run.
+        loaded (list): (path, image) tuples of the decoded images of the batch.
+        args (argparse.Namespace): Parsed arguments with the prompt and thresholds.
+        text_cache (dict): Output of predictor.encode_text for the prompt.
+        failed_paths (list): Receives the paths of images whose prediction failed.
+        
+    Returns:
+        tuple: (loaded, results) for the images that were predicted.
+    """
+    def predict(images):
+        return predictor.predict_batch(
+            images,
+            args.prompt,
+            box_threshold=args.box_threshold,
+            text_threshold=args.text_threshold,
+            text_cache=text_cache
+        )
+    
+    try:
+        # Run prediction on the whole batch
+        return loaded, predict([image for _, image in loaded])
+    except Exception as e:
+        print(f"Error processing batch starting at {loaded[0][0]}, retrying its images one at a time: {str(e)}")
+    
+    kept, results = [], []
+    for path, image in loaded:
+        try:
+            results.append(predict([image])[0])
+            kept.append((path, image))
+        except Exception as e:
+            print(f"Error processing {path}: {str(e)}")
+            failed_paths.append(path)
+    return kept, results
+
+def write_results(results_queue, annotations_dict, failed_paths, failed_event, vis_dir=None):
+    """
+    Pipeline stage C: convert predictions to annotations and write visualizations.
+    
+    Args:
+        results_queue (queue.Queue): Yields (loaded, results) tuples per batch until END_OF_STREAM.
+        annotations_dict (dict): Receives the annotations for each image path.
+        failed_paths (list): Receives the paths of images whose results could not be written.
+        failed_event (threading.Event): Set when a writer dies, which stops the other writers and
+            tells inference to stop queuing results.
+        vis_dir (str, optional): Directory for visualizations; None disables them.
+    """
+    try:
+        while not failed_event.is_set():
+            try:
+                item = results_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is END_OF_STREAM:
+                return
+            
+            loaded, results = item
+            for (image_path, image), (boxes, scores, labels) in zip(loaded, results):
+                try:
+                    # Convert to list of dictionaries
+                    annotations, boxes_np, scores_np = detections_to_annotations(boxes, scores, labels)
+                    
+                    # Store annotations
+                    annotations_dict[image_path] = annotations
+                    
+                    # Generate visualization if requested
+                    if vis_dir is not None:
+                        output_image_path = os.path.join(vis_dir, f"vis_{os.path.basename(image_path)}")
+                        write_visualization(image, boxes_np, labels, scores_np, output_image_path)
+                
+                except Exception as e:
+                    print(f"Error processing {image_path}: {str(e)}")
+                    failed_paths.append(image_path)
+    except BaseException:
+        failed_event.set()
+        raise
 
 def main():
     # Parse command line arguments
@@ -26,16 +174,13 @@ def main():
     
     # Create output directories
     os.makedirs(args.output_dir, exist_ok=True)
+    vis_dir = None
     if args.visualize:
         vis_dir = os.path.join(args.output_dir, "visualizations")
         os.makedirs(vis_dir, exist_ok=True)
     
     # Get list of image files
-    valid_extensions = [".jpg", ".jpeg", ".png", ".bmp"]
-    image_files = []
-    for file in os.listdir(args.input_dir):
-        if any(file.lower().endswith(ext) for ext in valid_extensions):
-            image_files.append(os.path.join(args.input_dir, file))
+    image_files = list_image_files(args.input_dir)
     
     if not image_files:
         print(f"No images found in {args.input_dir}")
@@ -43,58 +188,86 @@ def main():
     
     print(f"Found {len(image_files)} images")
     
-    # Initialize Grounding DINO predictor
-    predictor = GroundingDINOPredictor()
+    # Initialize Grounding DINO predictor once for the whole run
+    predictor = GroundingDINOPredictor(
+        half_weights=args.half_weights,
+        use_onnx=args.onnx,
+        compile_model=args.compile
+    )
+    
+    # The prompt is the same for every image, so tokenize it only once
+    text_cache = predictor.encode_text(args.prompt)
+    
+    # Run a three-stage pipeline connected by bounded queues: reader threads decode upcoming
+    # batches (A), the main thread runs batched inference on the GPU (B), and writer threads build
+    # annotations and save visualizations (C), so throughput approaches the slowest stage
+    decoded_queue = queue.Queue(maxsize=4)
+    results_queue = queue.Queue(maxsize=4)
+    stop_event = threading.Event()
+    writer_failed = threading.Event()
+    writer_count = 4 if args.visualize else 1
+    results_by_path = {}
+    image_sizes = {}
+    failed_paths = []
     
-    # Process each image
-    annotations_dict = {}
-    for image_path in tqdm(image_files, desc="Processing images"):
+    with ThreadPoolExecutor(max_workers=4) as decoder, ThreadPoolExecutor(max_workers=1 + writer_count) as stages, \
+            tqdm(total=len(image_files), desc="Processing images") as progress:
+        reader = stages.submit(read_batches, chunked(image_files, args.batch_size), decoder, decoded_queue, stop_event)
+        writers = [
+            stages.submit(write_results, results_queue, results_by_path, failed_paths, writer_failed, vis_dir)
+            for _ in range(writer_count)
+        ]
+        
         try:
-            # Load image
-            image = Image.open(image_path)
-            
-            # Run prediction
-            boxes, scores, labels = predictor.predict_image(
-                image,
-                args.prompt,
-                box_threshold=args.box_threshold,
-                text_threshold=args.text_threshold
-            )
-            
-            # Convert to list of dictionaries
-            annotations = []
-            for box, score, label in zip(boxes, scores, labels):
-                annotations.append({
-                    "bbox": box.tolist(),  # [x1, y1, x2, y2]
-                    "score": float(score),
-                    "label": label
-                })
-            
-            # Store annotations
-            annotations_dict[image_path] = annotations
-            
-            # Generate visualization if requested
-            if args.visualize:
-                img_np = np.array(image)
-                img_with_boxes = draw_boxes_on_image(img_np, annotations)
+            while True:
+                item = decoded_queue.get()
+                if item is END_OF_STREAM:
+                    break
                 
-                # Save visualization
-                output_image_path = os.path.join(vis_dir, f"vis_{os.path.basename(image_path)}")
-                plt.figure(figsize=(12, 12))
-                plt.imshow(img_with_boxes)
-                plt.axis('off')
-                plt.savefig(output_image_path, bbox_inches='tight', pad_inches=0)
-                plt.close()
-        
-        except Exception as e:
-            print(f"Error processing {image_path}: {str(e)}")
+                # Skip images that failed to decode
+                batch_paths, batch_images = item
+                loaded = [(path, image) for path, image in zip(batch_paths, batch_images) if image is not None]
+                failed_paths.extend(path for path, image in zip(batch_paths, batch_images) if image is None)
+                
+                if loaded:
+                    # Remember image sizes so saving the annotations does not reopen the images
+                    for path, image in loaded:
+                        image_sizes[path] = image.size
+                    
+                    loaded, results = predict_loaded(predictor, loaded, args, text_cache, failed_paths)
+                    
+                    # Stop queuing results once a writer has died, as nobody may be left to read them
+                    if loaded and not put_until_stopped(results_queue, (loaded, results), writer_failed):
+                        break
+                
+                # Count the batch only once its results are queued
+                progress.update(len(batch_paths))
+        finally:
+            # Stop the reader and let every writer drain its remaining work
+            stop_event.set()
+            for _ in range(writer_count):
+                put_until_stopped(results_queue, END_OF_STREAM, writer_failed)
+    
+    # Raise any error that stopped the reader or a writer
+    reader.result()
+    for writer in writers:
+        writer.result()
+    
+    # Keep the annotations in input order regardless of which writer finished first
+    annotations_dict = {path: results_by_path[path] for path in image_files if path in results_by_path}
     
     # Save annotations
-    save_annotations(annotations_dict, args.format, args.output_dir)
+    save_annotations(annotations_dict, args.format, args.output_dir, image_sizes)
     print(f"Saved annotations in {args.format} format to {args.output_dir}")
     
     if args.visualize:
         print(f"Saved visualizations to {vis_dir}")
+    
+    # Report every image that is missing from the output
+    if failed_paths:
+        print(f"Failed to process {len(failed_paths)} images:")
+        for path in failed_paths:
+            print(f"  {path}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
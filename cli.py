@@ -1,12 +1,12 @@
 import os
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import torch
-from PIL import Image
-import numpy as np
-import matplotlib.pyplot as plt
 from utils.grounding_dino import GroundingDINOPredictor
-from utils.visualization import draw_boxes_on_image
-from utils.annotation_utils import save_annotations, load_annotations
+from utils.visualization import draw_boxes, draw_boxes_on_image, image_to_array, save_visualization
+from utils.annotation_utils import detections_to_annotations, save_annotations, load_annotations
+from utils.image_utils import chunked, list_image_files, load_image, prefetch_batches
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Command-line interface for annotation tool")
@@ -21,6 +21,10 @@ def parse_args():
     annotate_parser.add_argument("--text-threshold", type=float, default=0.25, help="Text threshold")
     annotate_parser.add_argument("--format", type=str, default="COCO", choices=["COCO", "PASCAL VOC"], help="Output format")
     annotate_parser.add_argument("--visualize", action="store_true", help="Generate visualization images")
+    annotate_parser.add_argument("--batch-size", type=int, default=8, help="Number of images per inference batch")
+    annotate_parser.add_argument("--onnx", action="store_true", help="Run the ONNX export from download_model.py --onnx with ONNX Runtime")
+    annotate_parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile on CUDA (recompiles for each new image size)")
+    annotate_parser.add_argument("--half-weights", action="store_true", help="Use half precision weights on CUDA if they match FP32")
     
     # Convert command
     convert_parser = subparsers.add_parser("convert", help="Convert annotations between formats")
@@ -36,7 +40,34 @@ def parse_args():
     visualize_parser.add_argument("--format", type=str, required=True, choices=["COCO", "PASCAL VOC"], help="Annotation format")
     visualize_parser.add_argument("--output", type=str, help="Output image file (if not specified, display on screen)")
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.command == "annotate" and args.batch_size < 1:
+        annotate_parser.error("--batch-size must be at least 1")
+    return args
+
+@functools.lru_cache(maxsize=1)
+def get_predictor(half_weights=False, use_onnx=False, compile_model=False):
+    """
+    Create the Grounding DINO predictor once per process and reuse it across commands.
+    
+    Args:
+        half_weights (bool): Load half precision weights on CUDA.
+        use_onnx (bool): Run the ONNX export with ONNX Runtime.
+        compile_model (bool): Compile the model with torch.compile on CUDA.
+    """
+    return GroundingDINOPredictor(half_weights=half_weights, use_onnx=use_onnx, compile_model=compile_model)
+
+def load_image_for_visualization(image_path):
+    """
+    Load an image and also convert it to a numpy array, so both happen off the main thread.
+    
+    Args:
+        image_path (str): Path to the image file.
+    """
+    image = load_image(image_path)
+    if image is not None:
+        image_to_array(image)
+    return image
 
 def annotate(args):
     # Check if input is a file or directory
@@ -45,11 +76,7 @@ def annotate(args):
         image_files = [args.input]
     elif os.path.isdir(args.input):
         # Directory mode
-        valid_extensions = [".jpg", ".jpeg", ".png", ".bmp"]
-        image_files = []
-        for file in os.listdir(args.input):
-            if any(file.lower().endswith(ext) for ext in valid_extensions):
-                image_files.append(os.path.join(args.input, file))
+        image_files = list_image_files(args.input)
     else:
         print(f"Error: {args.input} is not a valid file or directory")
         return
@@ -66,83 +93,87 @@ def annotate(args):
         vis_dir = os.path.join(args.output, "visualizations")
         os.makedirs(vis_dir, exist_ok=True)
     
-    # Initialize Grounding DINO predictor
-    predictor = GroundingDINOPredictor()
+    # Get the shared Grounding DINO predictor
+    predictor = get_predictor(half_weights=args.half_weights, use_onnx=args.onnx, compile_model=args.compile)
     
-    # Process each image
+    # The prompt is the same for every image, so tokenize it only once
+    text_cache = predictor.encode_text(args.prompt)
+    
+    # Process images in batches; a bounded pool decodes the next batches while the current one runs
     annotations_dict = {}
-    for image_path in image_files:
-        try:
-            print(f"Processing {image_path}...")
-            
-            # Load image
-            image = Image.open(image_path)
+    image_sizes = {}
+    load_fn = load_image_for_visualization if args.visualize else load_image
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as loader:
+        for batch_paths, batch_images in prefetch_batches(loader, chunked(image_files, args.batch_size), load_fn=load_fn):
+            # Skip images that failed to decode
+            loaded = [(path, image) for path, image in zip(batch_paths, batch_images) if image is not None]
+            if not loaded:
+                continue
             
-            # Run prediction
-            boxes, scores, labels = predictor.predict_image(
-                image,
-                args.prompt,
-                box_threshold=args.box_threshold,
-                text_threshold=args.text_threshold
-            )
+            print(f"Processing {len(loaded)} images starting at {loaded[0][0]}...")
             
-            # Convert to list of dictionaries
-            annotations = []
-            for box, score, label in zip(boxes, scores, labels):
-                annotations.append({
-                    "bbox": box.tolist(),  # [x1, y1, x2, y2]
-                    "score": float(score),
-                    "label": label
-                })
+            try:
+                # Run prediction on the whole batch
+                results = predictor.predict_batch(
+                    [image for _, image in loaded],
+                    args.prompt,
+                    box_threshold=args.box_threshold,
+                    text_threshold=args.text_threshold,
+                    text_cache=text_cache
+                )
+            except Exception as e:
+                print(f"Error processing batch starting at {loaded[0][0]}: {str(e)}")
+                continue
             
-            print(f"  Found {len(annotations)} objects")
-            
-            # Store annotations
-            annotations_dict[image_path] = annotations
-            
-            # Generate visualization if requested
-            if args.visualize:
-                img_np = np.array(image)
-                img_with_boxes = draw_boxes_on_image(img_np, annotations)
+            for (image_path, image), (boxes, scores, labels) in zip(loaded, results):
+                try:
+                    # Convert to list of dictionaries
+                    annotations, boxes_np, scores_np = detections_to_annotations(boxes, scores, labels)
+                    
+                    print(f"  {image_path}: found {len(annotations)} objects")
+                    
+                    # Store annotations and the image size, so saving does not reopen the image
+                    annotations_dict[image_path] = annotations
+                    image_sizes[image_path] = image.size
+                    
+                    # Generate visualization if requested
+                    if args.visualize:
+                        img_np = image_to_array(image)
+                        img_with_boxes = draw_boxes(img_np, boxes_np, labels, scores_np)
+                        
+                        # Save visualization
+                        output_image_path = os.path.join(vis_dir, f"vis_{os.path.basename(image_path)}")
+                        save_visualization(img_with_boxes, output_image_path)
+                        print(f"  Saved visualization to {output_image_path}")
                 
-                # Save visualization
-                output_image_path = os.path.join(vis_dir, f"vis_{os.path.basename(image_path)}")
-                plt.figure(figsize=(12, 12))
-                plt.imshow(img_with_boxes)
-                plt.axis('off')
-                plt.savefig(output_image_path, bbox_inches='tight', pad_inches=0)
-                plt.close()
-                print(f"  Saved visualization to {output_image_path}")
-        
-        except Exception as e:
-            print(f"Error processing {image_path}: {str(e)}")
+                except Exception as e:
+                    print(f"Error processing {image_path}: {str(e)}")
     
     # Save annotations
-    save_annotations(annotations_dict, args.format, args.output)
+    save_annotations(annotations_dict, args.format, args.output, image_sizes)
     print(f"Saved annotations in {args.format} format to {args.output}")
 
 def convert(args):
     # Create output directory if it doesn't exist
     os.makedirs(args.output, exist_ok=True)
     
-    # Load annotations
+    # Load annotations along with the image sizes they record, so saving does not reopen the images
     print(f"Loading annotations from {args.input} in {args.input_format} format...")
-    annotations = load_annotations(args.input, args.input_format)
+    image_sizes = {}
+    annotations = load_annotations(args.input, args.input_format, image_sizes)
     
     # Save annotations in the output format
     print(f"Saving annotations to {args.output} in {args.output_format} format...")
-    save_annotations(annotations, args.output_format, args.output)
+    save_annotations(annotations, args.output_format, args.output, image_sizes)
     
     print("Conversion completed successfully!")
 
 def visualize(args):
     # Load image
-    try:
-        image = Image.open(args.image)
-        img_np = np.array(image)
-    except Exception as e:
-        print(f"Error loading image {args.image}: {str(e)}")
+    image = load_image(args.image)
+    if image is None:
         return
+    img_np = image_to_array(image)
     
     # Load annotations
     try:
@@ -169,13 +200,11 @@ def visualize(args):
     
     # Save or display the visualization
     if args.output:
-        plt.figure(figsize=(12, 12))
-        plt.imshow(img_with_boxes)
-        plt.axis('off')
-        plt.savefig(args.output, bbox_inches='tight', pad_inches=0)
-        plt.close()
+        save_visualization(img_with_boxes, args.output)
         print(f"Saved visualization to {args.output}")
     else:
+        # Import matplotlib only when displaying, since it is slow to import
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(12, 12))
         plt.imshow(img_with_boxes)
         plt.axis('off')
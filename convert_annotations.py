@@ -17,13 +17,14 @@ def main():
     # Create output directory if it doesn't exist
     os.makedirs(args.output, exist_ok=True)
     
-    # Load annotations
+    # Load annotations along with the image sizes they record, so saving does not reopen the images
     print(f"Loading annotations from {args.input} in {args.input_format} format...")
-    annotations = load_annotations(args.input, args.input_format)
+    image_sizes = {}
+    annotations = load_annotations(args.input, args.input_format, image_sizes)
     
     # Save annotations in the output format
     print(f"Saving annotations to {args.output} in {args.output_format} format...")
-    save_annotations(annotations, args.output_format, args.output)
+    save_annotations(annotations, args.output_format, args.output, image_sizes)
     
     print("Conversion completed successfully!")
 
@@ -1,14 +1,151 @@
 import os
+import argparse
+import numpy as np
 import torch
+from PIL import Image
 from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
+from transformers.models.grounding_dino import modeling_grounding_dino
+from utils.grounding_dino import ONNX_FILENAME, onnx_text_inputs, validation_batch
 
-def download_model(model_id="IDEA-Research/grounding-dino-tiny", output_dir="models"):
+# Graph inputs of the ONNX export, in the order of ONNXExportWrapper.forward
+ONNX_INPUT_NAMES = [
+    "pixel_values", "input_ids", "token_type_ids", "attention_mask", "pixel_mask",
+    "position_ids", "text_self_attention_masks"
+]
+
+# Largest difference in box coordinates and sigmoid scores allowed between ONNX Runtime and PyTorch
+ONNX_TOLERANCE = 1e-3
+
+class ONNXExportWrapper(torch.nn.Module):
+    def __init__(self, model):
+        """
+        Wrap a Grounding DINO model so the text position ids and self-attention masks become graph inputs.
+        
+        The model derives both from the special tokens of input_ids with data-dependent loops, which
+        tracing would freeze to the dummy prompt; the wrapper takes them precomputed on the host
+        (see onnx_text_inputs) and hands them to the model in place of its own computation.
+        
+        Args:
+            model (GroundingDinoForObjectDetection): The model to export.
+        """
+        super().__init__()
+        self.model = model
+    
+    def forward(self, pixel_values, input_ids, token_type_ids, attention_mask, pixel_mask,
+                position_ids, text_self_attention_masks):
+        """
+        Run the model with the given text position ids and self-attention masks.
+        
+        Returns:
+            tuple: (logits, pred_boxes) tensors.
+        """
+        original = modeling_grounding_dino.generate_masks_with_special_tokens_and_transfer_map
+        modeling_grounding_dino.generate_masks_with_special_tokens_and_transfer_map = (
+            lambda _: (text_self_attention_masks, position_ids)
+        )
+        try:
+            outputs = self.model(
+                pixel_values=pixel_values,
+                input_ids=input_ids,
+                token_type_ids=token_type_ids,
+                attention_mask=attention_mask,
+                pixel_mask=pixel_mask
+            )
+        finally:
+            modeling_grounding_dino.generate_masks_with_special_tokens_and_transfer_map = original
+        return outputs.logits, outputs.pred_boxes
+
+def validate_onnx(onnx_file, processor, model):
+    """
+    Check that an ONNX export matches the PyTorch model on a batch of two images whose prompts
+    differ from the dummy prompt used for tracing.
+    
+    Args:
+        onnx_file (str): Path to the exported model.
+        processor (AutoProcessor): Processor of the model.
+        model (GroundingDinoForObjectDetection): The PyTorch model that was exported.
+        
+    Raises:
+        AssertionError: If boxes or scores differ by more than ONNX_TOLERANCE.
+    """
+    import onnxruntime
+    
+    images, text = validation_batch()
+    inputs = processor(images=images, text=text, padding=True, return_tensors="pt")
+    
+    with torch.no_grad():
+        outputs = model(**inputs)
+    
+    session = onnxruntime.InferenceSession(onnx_file, providers=["CPUExecutionProvider"])
+    feed = dict(inputs)
+    feed.update(onnx_text_inputs(inputs["input_ids"]))
+    logits, pred_boxes = session.run(["logits", "pred_boxes"], {name: feed[name].numpy() for name in ONNX_INPUT_NAMES})
+    
+    # Compare sigmoid scores rather than logits, whose masked tokens are -inf
+    np.testing.assert_allclose(pred_boxes, outputs.pred_boxes.numpy(), atol=ONNX_TOLERANCE, rtol=0)
+    np.testing.assert_allclose(
+        torch.sigmoid(torch.from_numpy(logits)).numpy(), outputs.logits.sigmoid().numpy(), atol=ONNX_TOLERANCE, rtol=0
+    )
+
+def export_onnx(model_dir, opset_version=16):
+    """
+    Export a saved Grounding DINO model to ONNX so the predictor can run it with ONNX Runtime.
+    The export is written under its final name only once validate_onnx has passed.
+    
+    Args:
+        model_dir (str): Directory containing the saved processor and model.
+        opset_version (int): ONNX opset to export with.
+    """
+    processor = AutoProcessor.from_pretrained(model_dir)
+    model = AutoModelForZeroShotObjectDetection.from_pretrained(model_dir).eval()
+    
+    # Dummy inputs; batch size, prompt length and image size are exported as dynamic axes
+    inputs = processor(images=Image.new("RGB", (800, 800)), text=[["a cat", "a dog"]], return_tensors="pt")
+    inputs.update(onnx_text_inputs(inputs["input_ids"]))
+    dynamic_axes = {
+        "pixel_values": {0: "batch", 2: "height", 3: "width"},
+        "input_ids": {0: "batch", 1: "sequence"},
+        "token_type_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "sequence"},
+        "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+        "position_ids": {0: "batch", 1: "sequence"},
+        "text_self_attention_masks": {0: "batch", 1: "sequence", 2: "sequence"},
+        # The last logits axis is the contrastive head's fixed max_text_len, not the prompt length
+        "logits": {0: "batch"},
+        "pred_boxes": {0: "batch"}
+    }
+    
+    # Export next to the final file and only move it into place once it matches PyTorch
+    output_file = os.path.join(model_dir, ONNX_FILENAME)
+    tmp_file = output_file + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            ONNXExportWrapper(model),
+            tuple(inputs[name] for name in ONNX_INPUT_NAMES),
+            tmp_file,
+            input_names=ONNX_INPUT_NAMES,
+            output_names=["logits", "pred_boxes"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version
+        )
+    
+    try:
+        validate_onnx(tmp_file, processor, model)
+    except Exception:
+        os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, output_file)
+    
+    print(f"ONNX model validated and saved to {output_file}")
+
+def download_model(model_id="IDEA-Research/grounding-dino-tiny", output_dir="models", onnx=False):
     """
     Download the Grounding DINO model for offline use.
     
     Args:
         model_id (str): The Hugging Face model ID for Grounding DINO.
         output_dir (str): Directory to save the model files.
+        onnx (bool): Also export the model to ONNX.
     """
     print(f"Downloading model {model_id}...")
     
@@ -24,11 +161,19 @@ def download_model(model_id="IDEA-Research/grounding-dino-tiny", output_dir="mod
     model.save_pretrained(os.path.join(output_dir, os.path.basename(model_id)))
     
     print(f"Model saved to {os.path.join(output_dir, os.path.basename(model_id))}")
+    
+    # Export to ONNX if requested
+    if onnx:
+        export_onnx(os.path.join(output_dir, os.path.basename(model_id)))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the Grounding DINO model for offline use")
+    parser.add_argument("--onnx", action="store_true", help="Also export the model to ONNX for ONNX Runtime")
+    args = parser.parse_args()
+    
     # Download the tiny model by default
-    download_model()
+    download_model(onnx=args.onnx)
     
     # Uncomment to download other model variants
-    # download_model("IDEA-Research/grounding-dino-base")
-    # download_model("IDEA-Research/grounding-dino-b")
\ No newline at end of file
+    # download_model("IDEA-Research/grounding-dino-base", onnx=args.onnx)
+    # download_model("IDEA-Research/grounding-dino-b", onnx=args.onnx)
\ No newline at end of file
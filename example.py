@@ -1,12 +1,11 @@
 import os
 import argparse
 import torch
-from PIL import Image
 import numpy as np
-import matplotlib.pyplot as plt
 from utils.grounding_dino import GroundingDINOPredictor
-from utils.visualization import draw_boxes_on_image
-from utils.annotation_utils import save_annotations
+from utils.visualization import draw_boxes, save_visualization
+from utils.annotation_utils import detections_to_annotations, save_annotations
+from utils.image_utils import load_image
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Example script for Grounding DINO pre-annotation")
@@ -16,6 +15,8 @@ def parse_args():
     parser.add_argument("--text-threshold", type=float, default=0.25, help="Text threshold")
     parser.add_argument("--output", type=str, default="output", help="Output directory")
     parser.add_argument("--format", type=str, default="COCO", choices=["COCO", "PASCAL VOC"], help="Output format")
+    parser.add_argument("--onnx", action="store_true", help="Run the ONNX export from download_model.py --onnx with ONNX Runtime")
+    parser.add_argument("--half-weights", action="store_true", help="Use half precision weights on CUDA if they match FP32")
     return parser.parse_args()
 
 def main():
@@ -26,10 +27,12 @@ def main():
     os.makedirs(args.output, exist_ok=True)
     
     # Load image
-    image = Image.open(args.image)
+    image = load_image(args.image)
+    if image is None:
+        return
     
     # Initialize Grounding DINO predictor
-    predictor = GroundingDINOPredictor()
+    predictor = GroundingDINOPredictor(half_weights=args.half_weights, use_onnx=args.onnx)
     
     # Run prediction
     print(f"Running prediction with prompt: {args.prompt}")
@@ -41,34 +44,24 @@ def main():
     )
     
     # Convert to list of dictionaries
-    annotations = []
-    for box, score, label in zip(boxes, scores, labels):
-        annotations.append({
-            "bbox": box.tolist(),  # [x1, y1, x2, y2]
-            "score": float(score),
-            "label": label
-        })
+    annotations, boxes_np, scores_np = detections_to_annotations(boxes, scores, labels)
     
     print(f"Found {len(annotations)} objects")
     
     # Create annotations dictionary
     annotations_dict = {args.image: annotations}
     
-    # Save annotations
-    save_annotations(annotations_dict, args.format, args.output)
+    # Save annotations, reusing the size of the already loaded image
+    save_annotations(annotations_dict, args.format, args.output, {args.image: image.size})
     print(f"Saved annotations in {args.format} format to {args.output}")
     
-    # Visualize results
+    # Visualize results, drawing straight onto our own copy of the pixels
     img_np = np.array(image)
-    img_with_boxes = draw_boxes_on_image(img_np, annotations)
+    img_with_boxes = draw_boxes(img_np, boxes_np, labels, scores_np, inplace=True)
     
     # Save visualization
     output_image_path = os.path.join(args.output, f"visualization_{os.path.basename(args.image)}")
-    plt.figure(figsize=(12, 12))
-    plt.imshow(img_with_boxes)
-    plt.axis('off')
-    plt.savefig(output_image_path, bbox_inches='tight', pad_inches=0)
-    plt.close()
+    save_visualization(img_with_boxes, output_image_path)
     print(f"Saved visualization to {output_image_path}")
 
 if __name__ == "__main__":
@@ -1,15 +1,20 @@
+import argparse
 import torch
 from PIL import Image
 import numpy as np
-import matplotlib.pyplot as plt
 import requests
 import io
 from utils.grounding_dino import GroundingDINOPredictor
 from utils.visualization import draw_boxes_on_image
+from utils.annotation_utils import detections_to_annotations
 
-def test_with_sample_image():
+def test_with_sample_image(device=None, use_onnx=False):
     """
     Test the Grounding DINO model with a sample image from the internet.
+    
+    Args:
+        device (str, optional): Device to run the model on.
+        use_onnx (bool): Run the ONNX export with ONNX Runtime.
     """
     # URL of a sample image (COCO image)
     image_url = "http://images.cocodataset.org/val2017/000000039769.jpg"
@@ -20,7 +25,7 @@ def test_with_sample_image():
         image = Image.open(io.BytesIO(response.content))
         
         # Initialize the predictor
-        predictor = GroundingDINOPredictor()
+        predictor = GroundingDINOPredictor(device=device, use_onnx=use_onnx)
         
         # Run prediction
         text_prompt = "cat, remote"
@@ -34,23 +39,18 @@ def test_with_sample_image():
         )
         
         # Convert to list of dictionaries
-        annotations = []
-        for box, score, label in zip(boxes, scores, labels):
-            annotations.append({
-                "bbox": box.tolist(),  # [x1, y1, x2, y2]
-                "score": float(score),
-                "label": label
-            })
+        annotations, boxes_np, scores_np = detections_to_annotations(boxes, scores, labels)
         
         print(f"Found {len(annotations)} objects:")
-        for ann in annotations:
-            print(f"  {ann['label']}: {ann['score']:.2f} at {[int(x) for x in ann['bbox']]}")
+        for ann, int_box in zip(annotations, boxes_np.astype(np.int32).tolist()):
+            print(f"  {ann['label']}: {ann['score']:.2f} at {int_box}")
         
-        # Visualize results
+        # Visualize results, drawing straight onto our own copy of the pixels
         img_np = np.array(image)
-        img_with_boxes = draw_boxes_on_image(img_np, annotations)
+        img_with_boxes = draw_boxes_on_image(img_np, annotations, inplace=True)
         
-        # Display the result
+        # Display the result; matplotlib is imported only here, since it is slow to import
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(10, 10))
         plt.imshow(img_with_boxes)
         plt.axis('off')
@@ -63,15 +63,22 @@ def test_with_sample_image():
         print(f"Error during testing: {str(e)}")
         return False
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Test the Grounding DINO model on a sample image")
+    parser.add_argument("--onnx", action="store_true", help="Run the ONNX export from download_model.py --onnx with ONNX Runtime")
+    return parser.parse_args()
+
 def main():
+    # Parse command line arguments
+    args = parse_args()
+    
     print("Testing Grounding DINO model...")
     
     # Check if CUDA is available
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using device: {device}")
     
     # Run the test
-    success = test_with_sample_image()
+    success = test_with_sample_image(device, use_onnx=args.onnx)
     
     if success:
         print("\nTest completed successfully! The model is working correctly.")
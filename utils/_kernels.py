@@ -0,0 +1,61 @@
+import numpy as np
+
+# Numba is optional; without it the kernels below run as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+@njit(cache=True)
+def clip_rects(left, top, width, height, scale_x, scale_y, img_width, img_height):
+    """
+    Convert canvas rectangles to integer [x1, y1, x2, y2] boxes clipped to the image.
+
+    Args:
+        left (numpy.ndarray): Left edge of each rectangle.
+        top (numpy.ndarray): Top edge of each rectangle.
+        width (numpy.ndarray): Unscaled width of each rectangle.
+        height (numpy.ndarray): Unscaled height of each rectangle.
+        scale_x (numpy.ndarray): Horizontal scale factor of each rectangle.
+        scale_y (numpy.ndarray): Vertical scale factor of each rectangle.
+        img_width (int): Image width.
+        img_height (int): Image height.
+
+    Returns:
+        numpy.ndarray: (N, 4) int32 array of clipped boxes.
+    """
+    n = left.shape[0]
+    boxes = np.empty((n, 4), dtype=np.int32)
+    for i in range(n):
+        boxes[i, 0] = max(0, int(left[i]))
+        boxes[i, 1] = max(0, int(top[i]))
+        boxes[i, 2] = min(img_width, int(left[i] + width[i] * scale_x[i]))
+        boxes[i, 3] = min(img_height, int(top[i] + height[i] * scale_y[i]))
+    return boxes
+
+@njit("int64(float32[:, ::1], float32, float32)", cache=True, fastmath=True)
+def hit_test(bboxes, x, y):
+    """
+    Find the smallest box containing a point.
+
+    Args:
+        bboxes (numpy.ndarray): C-contiguous (N, 4) float32 array of [x1, y1, x2, y2] boxes.
+        x (float): X coordinate of the point.
+        y (float): Y coordinate of the point.
+
+    Returns:
+        int: Index of the first smallest box containing the point, or -1 if there is none.
+    """
+    best_index = -1
+    min_area = 0.0
+    for i in range(bboxes.shape[0]):
+        x1, y1, x2, y2 = bboxes[i, 0], bboxes[i, 1], bboxes[i, 2], bboxes[i, 3]
+        if x1 <= x and x <= x2 and y1 <= y and y <= y2:
+            area = (x2 - x1) * (y2 - y1)
+            if best_index < 0 or area < min_area:
+                best_index = i
+                min_area = area
+    return best_index
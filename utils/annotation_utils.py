@@ -1,11 +1,111 @@
 import os
 import json
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
 
-def save_annotations(annotations_dict, format_type, output_dir):
+# imagesize is optional; it reads (width, height) from the file header without decoding the image
+try:
+    import imagesize
+except ImportError:
+    imagesize = None
+
+# orjson is optional; when installed it reads and writes large annotation sets much faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# lxml is optional; its parser releases the GIL, so XML files can be parsed on several threads at once
+try:
+    from lxml import etree as xml_parser
+except ImportError:
+    xml_parser = ET
+
+def write_json(data, output_file):
+    """
+    Write data to a JSON file with two-space indentation, using orjson when available.
+    
+    Args:
+        data (dict): JSON-serializable data (NumPy arrays are accepted with orjson).
+        output_file (str): Path of the JSON file to write.
+    """
+    if orjson is not None:
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(output_file, "w") as f:
+            json.dump(data, f, indent=2)
+
+def read_json(file_path):
+    """
+    Read a JSON file, using orjson when available.
+    
+    Args:
+        file_path (str): Path of the JSON file to read.
+        
+    Returns:
+        The parsed JSON data.
+    """
+    if orjson is not None:
+        with open(file_path, "rb") as f:
+            return orjson.loads(f.read())
+    
+    with open(file_path, "r") as f:
+        return json.load(f)
+
+def get_image_size(image_path, image_sizes=None):
+    """
+    Get the (width, height) of an image, preferring an already known size.
+    
+    Args:
+        image_path (str): Path to the image file.
+        image_sizes (dict, optional): Mapping of image paths to known (width, height) sizes.
+        
+    Returns:
+        tuple: (width, height) of the image.
+    """
+    if image_sizes and image_path in image_sizes:
+        return tuple(image_sizes[image_path])
+    
+    if imagesize is not None:
+        width, height = imagesize.get(image_path)
+        if width > 0 and height > 0:
+            return width, height
+    
+    with Image.open(image_path) as img:
+        return img.size
+
+def detections_to_annotations(boxes, scores, labels):
+    """
+    Convert predicted boxes, scores and labels into annotation dictionaries, copying boxes and
+    scores to the host once.
+    
+    Args:
+        boxes (torch.Tensor or array-like): (N, 4) boxes in [x1, y1, x2, y2] format.
+        scores (torch.Tensor or array-like): (N,) confidence scores.
+        labels (list): N label strings.
+        
+    Returns:
+        tuple: (annotations, boxes, scores) with the list of annotation dictionaries and the
+            boxes and scores as NumPy arrays, for callers that also draw them.
+    """
+    if hasattr(boxes, "detach"):
+        boxes = boxes.detach().cpu().numpy()
+    if hasattr(scores, "detach"):
+        scores = scores.detach().cpu().numpy()
+    boxes, scores = np.asarray(boxes), np.asarray(scores)
+    
+    annotations = [
+        {"bbox": box, "score": score, "label": label}  # bbox is [x1, y1, x2, y2]
+        for box, score, label in zip(boxes.tolist(), scores.tolist(), labels)
+    ]
+    return annotations, boxes, scores
+
+def save_annotations(annotations_dict, format_type, output_dir, image_sizes=None):
     """
     Save annotations in the specified format.
     
@@ -13,23 +113,26 @@ def save_annotations(annotations_dict, format_type, output_dir):
         annotations_dict (dict): Dictionary mapping image paths to annotations.
         format_type (str): Format to save annotations in ('COCO' or 'PASCAL VOC').
         output_dir (str): Directory to save annotation files.
+        image_sizes (dict, optional): Mapping of image paths to (width, height); images
+            listed here are not reopened, which also allows paths that are not on disk.
     """
     os.makedirs(output_dir, exist_ok=True)
     
     if format_type == "COCO":
-        save_coco_format(annotations_dict, output_dir)
+        save_coco_format(annotations_dict, output_dir, image_sizes)
     elif format_type == "PASCAL VOC":
-        save_pascal_voc_format(annotations_dict, output_dir)
+        save_pascal_voc_format(annotations_dict, output_dir, image_sizes)
     else:
         raise ValueError(f"Unsupported format: {format_type}")
 
-def save_coco_format(annotations_dict, output_dir):
+def save_coco_format(annotations_dict, output_dir, image_sizes=None):
     """
     Save annotations in COCO format.
     
     Args:
         annotations_dict (dict): Dictionary mapping image paths to annotations.
         output_dir (str): Directory to save the COCO JSON file.
+        image_sizes (dict, optional): Mapping of image paths to known (width, height) sizes.
     """
     # Initialize COCO format structure
     coco_data = {
@@ -64,8 +167,7 @@ def save_coco_format(annotations_dict, output_dir):
     for image_id, (image_path, image_annotations) in enumerate(annotations_dict.items(), 1):
         # Get image information
         try:
-            with Image.open(image_path) as img:
-                width, height = img.size
+            width, height = get_image_size(image_path, image_sizes)
         except Exception as e:
             print(f"Error opening image {image_path}: {e}")
             continue
@@ -80,11 +182,12 @@ def save_coco_format(annotations_dict, output_dir):
             "date_captured": ""
         })
         
-        # Process annotations for this image
+        if not image_annotations:
+            continue
+        
+        # Add categories that don't exist yet
         for ann in image_annotations:
             label = ann["label"]
-            
-            # Add category if it doesn't exist
             if label not in categories:
                 categories[label] = category_id
                 coco_data["categories"].append({
@@ -93,40 +196,43 @@ def save_coco_format(annotations_dict, output_dir):
                     "supercategory": "none"
                 })
                 category_id += 1
-            
-            # Get bounding box
-            x1, y1, x2, y2 = ann["bbox"]
-            width = x2 - x1
-            height = y2 - y1
-            
-            # Add annotation to COCO format
-            coco_data["annotations"].append({
-                "id": annotation_id,
+        
+        # Convert all [x1, y1, x2, y2] boxes of this image to [x, y, width, height] and areas at once
+        boxes = np.asarray([ann["bbox"] for ann in image_annotations], dtype=np.float64).reshape(-1, 4)
+        sizes = boxes[:, 2:] - boxes[:, :2]
+        areas = sizes[:, 0] * sizes[:, 1]
+        coco_boxes = np.concatenate([boxes[:, :2], sizes], axis=1)
+        
+        # Add annotations to COCO format
+        coco_data["annotations"].extend(
+            {
+                "id": annotation_id + i,
                 "image_id": image_id,
-                "category_id": categories[label],
-                "bbox": [x1, y1, width, height],  # COCO format: [x, y, width, height]
-                "area": width * height,
+                "category_id": categories[ann["label"]],
+                "bbox": bbox,  # COCO format: [x, y, width, height]
+                "area": area,
                 "segmentation": [],
                 "iscrowd": 0,
                 "score": ann.get("score", 1.0)
-            })
-            
-            annotation_id += 1
+            }
+            for i, (ann, bbox, area) in enumerate(zip(image_annotations, coco_boxes.tolist(), areas.tolist()))
+        )
+        annotation_id += len(image_annotations)
     
     # Save COCO JSON file
     output_file = os.path.join(output_dir, "annotations.json")
-    with open(output_file, "w") as f:
-        json.dump(coco_data, f, indent=2)
+    write_json(coco_data, output_file)
     
     print(f"Saved COCO annotations to {output_file}")
 
-def save_pascal_voc_format(annotations_dict, output_dir):
+def save_pascal_voc_format(annotations_dict, output_dir, image_sizes=None):
     """
     Save annotations in PASCAL VOC format.
     
     Args:
         annotations_dict (dict): Dictionary mapping image paths to annotations.
         output_dir (str): Directory to save the XML files.
+        image_sizes (dict, optional): Mapping of image paths to known (width, height) sizes.
     """
     # Create annotations directory
     annotations_dir = os.path.join(output_dir, "Annotations")
@@ -136,9 +242,8 @@ def save_pascal_voc_format(annotations_dict, output_dir):
     for image_path, image_annotations in annotations_dict.items():
         # Get image information
         try:
-            with Image.open(image_path) as img:
-                width, height = img.size
-                depth = 3  # Assume RGB
+            width, height = get_image_size(image_path, image_sizes)
+            depth = 3  # Assume RGB
         except Exception as e:
             print(f"Error opening image {image_path}: {e}")
             continue
@@ -164,8 +269,11 @@ def save_pascal_voc_format(annotations_dict, output_dir):
         # Add segmented information
         ET.SubElement(annotation, "segmented").text = "0"
         
+        # Convert all box coordinates of this image to integers in one cast (truncating like int())
+        int_boxes = np.asarray([ann["bbox"] for ann in image_annotations], dtype=np.int32).reshape(-1, 4)
+        
         # Add object annotations
-        for ann in image_annotations:
+        for ann, (x1, y1, x2, y2) in zip(image_annotations, int_boxes.tolist()):
             obj = ET.SubElement(annotation, "object")
             ET.SubElement(obj, "name").text = ann["label"]
             ET.SubElement(obj, "pose").text = "Unspecified"
@@ -174,7 +282,6 @@ def save_pascal_voc_format(annotations_dict, output_dir):
             
             # Add bounding box
             bbox = ET.SubElement(obj, "bndbox")
-            x1, y1, x2, y2 = [int(coord) for coord in ann["bbox"]]
             ET.SubElement(bbox, "xmin").text = str(x1)
             ET.SubElement(bbox, "ymin").text = str(y1)
             ET.SubElement(bbox, "xmax").text = str(x2)
@@ -183,84 +290,142 @@ def save_pascal_voc_format(annotations_dict, output_dir):
             # Add confidence score as an extra field
             ET.SubElement(obj, "confidence").text = str(ann.get("score", 1.0))
         
-        # Convert to pretty XML string
-        xml_str = minidom.parseString(ET.tostring(annotation)).toprettyxml(indent="  ")
+        # Indent the tree in place instead of round-tripping it through minidom
+        ET.indent(annotation, space="  ")
         
         # Save XML file
         output_file = os.path.join(annotations_dir, f"{os.path.splitext(os.path.basename(image_path))[0]}.xml")
-        with open(output_file, "w") as f:
-            f.write(xml_str)
+        ET.ElementTree(annotation).write(output_file, encoding="utf-8", xml_declaration=True)
     
     print(f"Saved PASCAL VOC annotations to {annotations_dir}")
 
-def load_annotations(file_path, format_type):
+def load_annotations(file_path, format_type, image_sizes=None):
     """
     Load annotations from a file.
     
     Args:
         file_path (str): Path to the annotation file.
         format_type (str): Format of the annotation file ('COCO' or 'PASCAL VOC').
+        image_sizes (dict, optional): Filled with the (width, height) recorded for each image,
+            so it can be passed to save_annotations without reopening the images.
         
     Returns:
         dict: Dictionary mapping image paths to annotations.
     """
     if format_type == "COCO":
-        return load_coco_format(file_path)
+        return load_coco_format(file_path, image_sizes)
     elif format_type == "PASCAL VOC":
-        return load_pascal_voc_format(file_path)
+        return load_pascal_voc_format(file_path, image_sizes)
     else:
         raise ValueError(f"Unsupported format: {format_type}")
 
-def load_coco_format(file_path):
+def load_coco_format(file_path, image_sizes=None):
     """
     Load annotations from a COCO format JSON file.
     
     Args:
         file_path (str): Path to the COCO JSON file.
+        image_sizes (dict, optional): Filled with the (width, height) of each image that records them.
         
     Returns:
         dict: Dictionary mapping image paths to annotations.
     """
-    with open(file_path, "r") as f:
-        coco_data = json.load(f)
+    coco_data = read_json(file_path)
     
-    # Create a mapping from image ID to file name
+    # Create mappings from image ID to file name and from category ID to category name
     image_id_to_file = {img["id"]: img["file_name"] for img in coco_data["images"]}
-    
-    # Create a mapping from category ID to category name
     category_id_to_name = {cat["id"]: cat["name"] for cat in coco_data["categories"]}
     
-    # Group annotations by image ID
-    annotations_by_image = {}
-    for ann in coco_data["annotations"]:
-        image_id = ann["image_id"]
-        if image_id not in annotations_by_image:
-            annotations_by_image[image_id] = []
-        
-        # Convert COCO format [x, y, width, height] to [x1, y1, x2, y2]
-        x, y, w, h = ann["bbox"]
-        bbox = [x, y, x + w, y + h]
-        
-        annotations_by_image[image_id].append({
+    # Convert all COCO format [x, y, width, height] boxes to [x1, y1, x2, y2] at once
+    coco_annotations = coco_data["annotations"]
+    bboxes = np.asarray([ann["bbox"] for ann in coco_annotations], dtype=np.float64).reshape(-1, 4)
+    bboxes[:, 2:] += bboxes[:, :2]
+    
+    # Group annotations by file name in a single pass
+    result = defaultdict(list)
+    for ann, bbox in zip(coco_annotations, bboxes.tolist()):
+        result[image_id_to_file[ann["image_id"]]].append({
             "bbox": bbox,
             "score": ann.get("score", 1.0),
             "label": category_id_to_name[ann["category_id"]]
         })
     
-    # Map file names to annotations
-    result = {}
-    for image_id, annotations in annotations_by_image.items():
-        file_name = image_id_to_file[image_id]
-        result[file_name] = annotations
+    # Record the image sizes stored in the file
+    if image_sizes is not None:
+        for img in coco_data["images"]:
+            if img.get("width") and img.get("height"):
+                image_sizes[img["file_name"]] = (img["width"], img["height"])
     
-    return result
+    return dict(result)
 
-def load_pascal_voc_format(directory):
+def parse_pascal_voc_file(file_path):
+    """
+    Parse a single PASCAL VOC XML file.
+    
+    Args:
+        file_path (str): Path to the XML annotation file.
+        
+    Returns:
+        tuple: (image_path, annotations, size) for the image described by the file, where size
+            is the recorded (width, height) or None.
+    """
+    # Parse XML file
+    tree = xml_parser.parse(file_path)
+    root = tree.getroot()
+    
+    # Get image path
+    image_path = root.find("path").text if root.find("path") is not None else ""
+    if not image_path:
+        # Try to construct image path from folder and filename
+        folder = root.find("folder").text if root.find("folder") is not None else ""
+        filename = root.find("filename").text if root.find("filename") is not None else ""
+        image_path = os.path.join(folder, filename)
+    
+    # Get image size if recorded; a missing or empty size element is not an error
+    try:
+        size = (int(root.find("size/width").text), int(root.find("size/height").text))
+    except (AttributeError, TypeError, ValueError):
+        size = None
+    if size is not None and min(size) <= 0:
+        size = None
+    
+    # Get annotations
+    annotations = []
+    for obj in root.findall("object"):
+        name = obj.find("name").text
+        bbox = obj.find("bndbox")
+        
+        x1 = int(bbox.find("xmin").text)
+        y1 = int(bbox.find("ymin").text)
+        x2 = int(bbox.find("xmax").text)
+        y2 = int(bbox.find("ymax").text)
+        
+        # Get confidence score if available
+        confidence = obj.find("confidence")
+        score = float(confidence.text) if confidence is not None else 1.0
+        
+        annotations.append({
+            "bbox": [x1, y1, x2, y2],
+            "score": score,
+            "label": name
+        })
+    
+    return image_path, annotations, size
+
+def _try_parse_pascal_voc_file(file_path):
+    # Hand errors back to the caller so they are reported in file order rather than from worker threads
+    try:
+        return parse_pascal_voc_file(file_path), None
+    except Exception as e:
+        return None, e
+
+def load_pascal_voc_format(directory, image_sizes=None):
     """
     Load annotations from PASCAL VOC format XML files.
     
     Args:
         directory (str): Directory containing XML annotation files.
+        image_sizes (dict, optional): Filled with the (width, height) of each image that records them.
         
     Returns:
         dict: Dictionary mapping image paths to annotations.
@@ -268,49 +433,19 @@ def load_pascal_voc_format(directory):
     result = {}
     
     # Find all XML files in the directory
-    for file_name in os.listdir(directory):
-        if not file_name.endswith(".xml"):
-            continue
-        
-        file_path = os.path.join(directory, file_name)
-        
-        try:
-            # Parse XML file
-            tree = ET.parse(file_path)
-            root = tree.getroot()
-            
-            # Get image path
-            image_path = root.find("path").text if root.find("path") is not None else ""
-            if not image_path:
-                # Try to construct image path from folder and filename
-                folder = root.find("folder").text if root.find("folder") is not None else ""
-                filename = root.find("filename").text if root.find("filename") is not None else ""
-                image_path = os.path.join(folder, filename)
-            
-            # Get annotations
-            annotations = []
-            for obj in root.findall("object"):
-                name = obj.find("name").text
-                bbox = obj.find("bndbox")
-                
-                x1 = int(bbox.find("xmin").text)
-                y1 = int(bbox.find("ymin").text)
-                x2 = int(bbox.find("xmax").text)
-                y2 = int(bbox.find("ymax").text)
-                
-                # Get confidence score if available
-                confidence = obj.find("confidence")
-                score = float(confidence.text) if confidence is not None else 1.0
-                
-                annotations.append({
-                    "bbox": [x1, y1, x2, y2],
-                    "score": score,
-                    "label": name
-                })
+    with os.scandir(directory) as entries:
+        xml_files = sorted(entry.path for entry in entries if entry.is_file() and entry.name.endswith(".xml"))
+    
+    # Parse the files on a thread pool; map keeps the results in file order
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for file_path, (parsed, error) in zip(xml_files, executor.map(_try_parse_pascal_voc_file, xml_files)):
+            if error is not None:
+                print(f"Error parsing XML file {file_path}: {error}")
+                continue
             
+            image_path, annotations, size = parsed
             result[image_path] = annotations
-        
-        except Exception as e:
-            print(f"Error parsing XML file {file_path}: {e}")
+            if image_sizes is not None and size is not None:
+                image_sizes[image_path] = size
     
-    return result
\ No newline at end of file
+    return result
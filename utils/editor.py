@@ -1,5 +1,9 @@
 import numpy as np
 from PIL import Image
+from utils._kernels import hit_test
+
+# Box component moved by each resize edge, and whether it follows dx (0) or dy (1)
+_EDGE_MAP = {"left": (0, 0), "top": (1, 1), "right": (2, 0), "bottom": (3, 1)}
 
 class AnnotationEditor:
     def __init__(self, image_path, image):
@@ -12,11 +16,61 @@ class AnnotationEditor:
         """
         self.image_path = image_path
         self.image = image
-        self.annotations = []
         self.selected_annotation_index = None
         
-        # Image dimensions
+        # Annotations are stored as parallel arrays: boxes and scores live in buffers with spare
+        # capacity so adding annotations does not reallocate every time, labels in a list
+        self._n = 0
+        self._bboxes = np.empty((0, 4), dtype=np.float32)
+        self._scores = np.empty(0, dtype=np.float64)
+        self.labels = []
+        
+        # Image dimensions, and the bounds each box component is clipped to
+        self.width, self.height = image.size
+        self._lo = np.zeros(4, dtype=np.float32)
+        self._hi = np.array([self.width - 1, self.height - 1] * 2, dtype=np.float32)
+    
+    @property
+    def bboxes(self):
+        """(N, 4) float32 array of [x1, y1, x2, y2] boxes, a view into the editor's buffer."""
+        return self._bboxes[:self._n]
+    
+    @property
+    def scores(self):
+        """(N,) array of confidence scores, a view into the editor's buffer."""
+        return self._scores[:self._n]
+    
+    def _reserve(self, capacity):
+        """
+        Grow the box and score buffers to hold at least the given number of annotations.
+        
+        Args:
+            capacity (int): Number of annotations the buffers must hold.
+        """
+        if capacity <= len(self._bboxes):
+            return
+        
+        # Double the capacity, like a dynamic array, so repeated adds are amortized
+        capacity = max(capacity, 2 * len(self._bboxes), 8)
+        bboxes = np.empty((capacity, 4), dtype=np.float32)
+        scores = np.empty(capacity, dtype=np.float64)
+        bboxes[:self._n] = self.bboxes
+        scores[:self._n] = self.scores
+        self._bboxes, self._scores = bboxes, scores
+    
+    def load(self, image_path, image):
+        """
+        Switch the editor to another image, reusing this instance.
+        
+        Args:
+            image_path (str): Path to the image file.
+            image (PIL.Image): The image object.
+        """
+        self.image_path = image_path
+        self.image = image
         self.width, self.height = image.size
+        self._hi = np.array([self.width - 1, self.height - 1] * 2, dtype=np.float32)
+        self.set_annotations([])
     
     def set_annotations(self, annotations):
         """
@@ -25,7 +79,13 @@ class AnnotationEditor:
         Args:
             annotations (list): List of annotation dictionaries.
         """
-        self.annotations = annotations
+        self._n = 0
+        self._reserve(len(annotations))
+        self._n = len(annotations)
+        if annotations:
+            self.bboxes[:] = [ann["bbox"] for ann in annotations]
+            self.scores[:] = [ann.get("score", 1.0) for ann in annotations]
+        self.labels = [ann["label"] for ann in annotations]
         self.selected_annotation_index = None
     
     def add_annotation(self, bbox, label, score=1.0):
@@ -40,14 +100,12 @@ class AnnotationEditor:
         Returns:
             int: Index of the new annotation.
         """
-        annotation = {
-            "bbox": bbox,
-            "label": label,
-            "score": score
-        }
-        
-        self.annotations.append(annotation)
-        return len(self.annotations) - 1
+        self._reserve(self._n + 1)
+        self._bboxes[self._n] = bbox
+        self._scores[self._n] = score
+        self.labels.append(label)
+        self._n += 1
+        return self._n - 1
     
     def update_annotation(self, index, bbox=None, label=None, score=None):
         """
@@ -62,17 +120,17 @@ class AnnotationEditor:
         Returns:
             bool: True if successful, False otherwise.
         """
-        if index < 0 or index >= len(self.annotations):
+        if index < 0 or index >= self._n:
             return False
         
         if bbox is not None:
-            self.annotations[index]["bbox"] = bbox
+            self._bboxes[index] = bbox
         
         if label is not None:
-            self.annotations[index]["label"] = label
+            self.labels[index] = label
         
         if score is not None:
-            self.annotations[index]["score"] = score
+            self._scores[index] = score
         
         return True
     
@@ -86,15 +144,19 @@ class AnnotationEditor:
         Returns:
             bool: True if successful, False otherwise.
         """
-        if index < 0 or index >= len(self.annotations):
+        if index < 0 or index >= self._n:
             return False
         
-        self.annotations.pop(index)
+        # Shift the following annotations down by one
+        self._bboxes[index:self._n - 1] = self._bboxes[index + 1:self._n]
+        self._scores[index:self._n - 1] = self._scores[index + 1:self._n]
+        self.labels.pop(index)
+        self._n -= 1
         
         # Reset selected annotation if it was deleted
         if self.selected_annotation_index == index:
             self.selected_annotation_index = None
-        elif self.selected_annotation_index > index:
+        elif self.selected_annotation_index is not None and self.selected_annotation_index > index:
             self.selected_annotation_index -= 1
         
         return True
@@ -110,21 +172,10 @@ class AnnotationEditor:
         Returns:
             int: Index of the selected annotation, or None if no annotation was selected.
         """
-        selected_index = None
-        min_area = float('inf')
-        
-        for i, ann in enumerate(self.annotations):
-            x1, y1, x2, y2 = ann["bbox"]
-            
-            # Check if point is inside the bounding box
-            if x1 <= x <= x2 and y1 <= y <= y2:
-                # Calculate area of the bounding box
-                area = (x2 - x1) * (y2 - y1)
-                
-                # Select the smallest bounding box containing the point
-                if area < min_area:
-                    min_area = area
-                    selected_index = i
+        # Select the smallest bounding box containing the point
+        selected_index = hit_test(self.bboxes, np.float32(x), np.float32(y))
+        if selected_index < 0:
+            selected_index = None
         
         self.selected_annotation_index = selected_index
         return selected_index
@@ -134,12 +185,17 @@ class AnnotationEditor:
         Get the currently selected annotation.
         
         Returns:
-            dict: The selected annotation, or None if no annotation is selected.
+            dict: A copy of the selected annotation, or None if no annotation is selected.
         """
         if self.selected_annotation_index is None:
             return None
         
-        return self.annotations[self.selected_annotation_index]
+        index = self.selected_annotation_index
+        return {
+            "bbox": self._bboxes[index].tolist(),
+            "label": self.labels[index],
+            "score": float(self._scores[index])
+        }
     
     def move_annotation(self, index, dx, dy):
         """
@@ -153,25 +209,15 @@ class AnnotationEditor:
         Returns:
             bool: True if successful, False otherwise.
         """
-        if index < 0 or index >= len(self.annotations):
+        if index < 0 or index >= self._n:
             return False
         
-        x1, y1, x2, y2 = self.annotations[index]["bbox"]
-        
-        # Apply deltas
-        x1 += dx
-        y1 += dy
-        x2 += dx
-        y2 += dy
+        # Apply deltas in place
+        box = self._bboxes[index]
+        box += (dx, dy, dx, dy)
         
         # Ensure the box stays within the image boundaries
-        x1 = max(0, min(x1, self.width - 1))
-        y1 = max(0, min(y1, self.height - 1))
-        x2 = max(0, min(x2, self.width - 1))
-        y2 = max(0, min(y2, self.height - 1))
-        
-        # Update the annotation
-        self.annotations[index]["bbox"] = [x1, y1, x2, y2]
+        np.clip(box, self._lo, self._hi, out=box)
         
         return True
     
@@ -188,31 +234,26 @@ class AnnotationEditor:
         Returns:
             bool: True if successful, False otherwise.
         """
-        if index < 0 or index >= len(self.annotations):
+        if index < 0 or index >= self._n:
             return False
         
-        x1, y1, x2, y2 = self.annotations[index]["bbox"]
-        
-        # Apply changes based on which edge is being moved
-        if edge == "top":
-            y1 += dy
-        elif edge == "bottom":
-            y2 += dy
-        elif edge == "left":
-            x1 += dx
-        elif edge == "right":
-            x2 += dx
-        else:
+        edge_entry = _EDGE_MAP.get(edge)
+        if edge_entry is None:
             return False
         
-        # Ensure the box stays within the image boundaries and has positive dimensions
-        x1 = max(0, min(x1, x2 - 1, self.width - 1))
-        y1 = max(0, min(y1, y2 - 1, self.height - 1))
-        x2 = max(x1 + 1, min(x2, self.width - 1))
-        y2 = max(y1 + 1, min(y2, self.height - 1))
+        # Apply the change to the component of the edge being moved
+        component, axis = edge_entry
+        box = self._bboxes[index]
+        box[component] += (dx, dy)[axis]
         
-        # Update the annotation
-        self.annotations[index]["bbox"] = [x1, y1, x2, y2]
+        # Ensure the box stays within the image boundaries and has positive dimensions: the top-left
+        # corner is clamped against the unclipped bottom-right corner first, then the bottom-right
+        # corner against the image and the new top-left corner
+        top_left, bottom_right = box[:2], box[2:]
+        np.minimum(top_left, np.minimum(bottom_right - 1, self._hi[:2]), out=top_left)
+        np.maximum(top_left, self._lo[:2], out=top_left)
+        np.minimum(bottom_right, self._hi[2:], out=bottom_right)
+        np.maximum(bottom_right, top_left + 1, out=bottom_right)
         
         return True
     
@@ -221,6 +262,22 @@ class AnnotationEditor:
         Get all annotations for the current image.
         
         Returns:
-            list: List of annotation dictionaries.
+            list: List of annotation dictionaries, built from the editor's arrays.
+        """
+        return [
+            {"bbox": bbox, "label": label, "score": score}
+            for bbox, label, score in zip(self.bboxes.tolist(), self.labels, self.scores.tolist())
+        ]
+    
+    def get_annotations_array(self):
+        """
+        Get all annotations for the current image as arrays, without building dicts.
+        
+        The boxes and scores are views into the editor's buffers and the labels list is the
+        editor's own, so callers must copy them before mutating or keeping them across edits.
+        
+        Returns:
+            tuple: (bboxes, labels, scores) with an (N, 4) float32 array of [x1, y1, x2, y2]
+                boxes, a list of N labels and an (N,) array of scores.
         """
-        return self.annotations
\ No newline at end of file
+        return self.bboxes, self.labels, self.scores
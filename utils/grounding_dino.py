@@ -1,50 +1,459 @@
+import os
+import importlib.util
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
 import torch
 from PIL import Image
 import numpy as np
 from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
 
+# ONNX Runtime is optional; it runs the model exported by download_model.py --onnx
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# Directory where download_model.py saves local model snapshots
+MODELS_DIR = "models"
+
+# File name of the ONNX export inside a local model snapshot
+ONNX_FILENAME = "model.onnx"
+
+# Number of recently preprocessed single images whose model inputs are kept for reuse
+IMAGE_CACHE_SIZE = 4
+
+# Number of recent prompts whose parsed labels and tokenized tensors are kept for reuse
+PROMPT_CACHE_SIZE = 16
+
+# Tokenized prompts are padded to one of these lengths so a compiled model sees few text shapes
+TEXT_BUCKETS = (16, 32, 64)
+
+# Largest difference in normalized box coordinates and sigmoid scores allowed between half
+# precision weights and FP32 weights on the validation batch; well below the threshold steps
+HALF_WEIGHTS_TOLERANCE = 1e-2
+
+# Allow TF32 matmuls and let cuDNN pick the fastest kernels for our input shapes
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+def validation_batch():
+    """
+    Build a small fixed batch for checking a reduced precision or exported model against FP32.
+    
+    Returns:
+        tuple: (images, text) with two differently sized PIL images, so padding and the pixel
+            mask are exercised, and one list of labels per image.
+    """
+    rng = np.random.default_rng(0)
+    images = [
+        Image.fromarray(rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)),
+        Image.fromarray(rng.integers(0, 256, (600, 500, 3), dtype=np.uint8))
+    ]
+    text = [["a person", "a bicycle", "a traffic light"], ["a bird"]]
+    return images, text
+
+def onnx_text_inputs(input_ids):
+    """
+    Compute the text position ids and self-attention masks that the ONNX export takes as inputs.
+    Grounding DINO derives them from the special tokens of each prompt, which the export cannot
+    trace, so they are computed on the host from the tokenized prompt.
+    
+    Args:
+        input_ids (torch.Tensor): (B, L) token ids of the tokenized prompts.
+        
+    Returns:
+        dict: position_ids (B, L) and text_self_attention_masks (B, L, L) tensors.
+    """
+    # Imported here since it is a private helper only the ONNX path needs
+    from transformers.models.grounding_dino.modeling_grounding_dino import generate_masks_with_special_tokens_and_transfer_map
+    
+    text_self_attention_masks, position_ids = generate_masks_with_special_tokens_and_transfer_map(input_ids)
+    return {"position_ids": position_ids, "text_self_attention_masks": text_self_attention_masks}
+
 class GroundingDINOPredictor:
-    def __init__(self, model_id="IDEA-Research/grounding-dino-tiny"):
+    def __init__(self, model_id="IDEA-Research/grounding-dino-tiny", device=None, half_weights=False, use_onnx=False,
+                 compile_model=False):
         """
         Initialize the Grounding DINO predictor with the specified model.
         
         Args:
-            model_id (str): The Hugging Face model ID for Grounding DINO.
+            model_id (str): The Hugging Face model ID for Grounding DINO. A snapshot saved by
+                download_model.py under models/<name> is used instead of the hub cache when present.
+            device (str, optional): Device to run on; defaults to CUDA when available.
+            half_weights (bool): Store the weights in the autocast dtype on CUDA instead of FP32,
+                halving their memory and bandwidth. The half precision model is checked against
+                FP32 weights on a validation batch and FP32 is kept if they differ by more than
+                HALF_WEIGHTS_TOLERANCE.
+            use_onnx (bool): Run the snapshot's ONNX export, written by download_model.py --onnx
+                once it matched PyTorch, with ONNX Runtime instead of PyTorch.
+            compile_model (bool): Compile the model with torch.compile on CUDA. Off by default:
+                only the text is bucketed, so every new image size or partial batch triggers a
+                recompile and a new CUDA graph recording, which pays off only for long runs over
+                images of few distinct sizes.
         """
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.use_cuda = torch.device(self.device).type == "cuda"
         print(f"Using device: {self.device}")
         
-        # Load model and processor
-        self.processor = AutoProcessor.from_pretrained(model_id)
-        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(self.device)
+        # Prefer the local snapshot, which skips resolving and re-hashing the hub cache
+        local_path = os.path.join(MODELS_DIR, os.path.basename(model_id))
+        model_path = local_path if os.path.isdir(local_path) else model_id
+        
+        # Load processor
+        self.processor = AutoProcessor.from_pretrained(model_path)
+        
+        # Preprocessed inputs of recent single images, keyed by id(image) and holding the image
+        # itself so a reused id of a freed image cannot match; the lock keeps the LRU consistent
+        # when a cached predictor is shared by several threads, e.g. Streamlit sessions
+        self._image_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+        # Parsed label lists and tokenized prompts of recent prompts, keyed by the raw prompt text
+        # and guarded by the same lock
+        self._prompt_cache = OrderedDict()
+        self._tokenized_cache = OrderedDict()
+        
+        # Original eager model, kept while a compiled model is in use so we can fall back to it
+        self._eager_model = None
+        
+        # Use the ONNX export when requested; its inputs stay on the host and ONNX Runtime moves them
+        onnx_path = os.path.join(local_path, ONNX_FILENAME)
+        self.onnx_session = None
+        if use_onnx and onnxruntime is not None and os.path.isfile(onnx_path):
+            providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if self.use_cuda else ["CPUExecutionProvider"]
+            providers = [provider for provider in providers if provider in onnxruntime.get_available_providers()]
+            self.onnx_session = onnxruntime.InferenceSession(onnx_path, providers=providers)
+            self.onnx_input_names = [model_input.name for model_input in self.onnx_session.get_inputs()]
+        
+        # Older exports traced the text masks for their dummy prompt; only run exports that take them as inputs
+        if self.onnx_session is not None and "text_self_attention_masks" not in self.onnx_input_names:
+            print(f"Ignoring {onnx_path}, which predates the validated export; re-run download_model.py --onnx")
+            self.onnx_session = None
+        elif use_onnx and self.onnx_session is None:
+            print(f"ONNX Runtime or {onnx_path} not found, using PyTorch")
+        
+        if self.onnx_session is not None:
+            self.model = None
+            self.copy_stream = None
+            print(f"Using ONNX Runtime model {onnx_path} ({', '.join(self.onnx_session.get_providers())})")
+            return
+        
+        # Autocast to BF16 where the GPU supports it, as it keeps FP32's range; FP16 otherwise
+        self.autocast_dtype = torch.bfloat16 if self.use_cuda and torch.cuda.is_bf16_supported() else torch.float16
+        
+        # Keep FP32 weights and let autocast run matmuls in half precision, unless half weights are requested
+        self.model_dtype = self.autocast_dtype if self.use_cuda and half_weights else torch.float32
+        
+        # Load model
+        self.model = self._load_model(model_path, self.model_dtype)
+        
+        # Side stream for host-to-device copies, so uploading inputs can overlap with queued kernels
+        self.copy_stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        
+        # Only keep half precision weights if they reproduce the FP32 detections
+        if self.model_dtype != torch.float32:
+            reference = self._load_model(model_path, torch.float32)
+            if not self._matches_reference(reference):
+                self.model, self.model_dtype = reference, torch.float32
+            del reference
+            torch.cuda.empty_cache()
+        
+        # Compile on CUDA when requested, where fused kernels and CUDA graphs pay off
+        if compile_model and self.use_cuda:
+            self.compile()
+    
+    def _load_model(self, model_path, dtype):
+        """
+        Load the model onto the device in evaluation mode.
+        
+        Args:
+            model_path (str): Local snapshot directory or Hugging Face model ID.
+            dtype (torch.dtype): dtype to load the weights in.
+            
+        Returns:
+            GroundingDinoForObjectDetection: The loaded model.
+        """
+        # low_cpu_mem_usage loads weights straight into the model
+        # instead of into a randomly initialized copy first, but needs accelerate
+        return AutoModelForZeroShotObjectDetection.from_pretrained(
+            model_path,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=importlib.util.find_spec("accelerate") is not None
+        ).to(self.device).eval()
+    
+    def _matches_reference(self, reference):
+        """
+        Compare the half precision model against FP32 weights on validation_batch().
+        
+        Args:
+            reference (GroundingDinoForObjectDetection): The model loaded with FP32 weights.
+            
+        Returns:
+            bool: True if boxes and scores agree within HALF_WEIGHTS_TOLERANCE.
+        """
+        images, text = validation_batch()
+        inputs = self.processor(images=images, text=text, padding=True, return_tensors="pt")
+        with torch.inference_mode():
+            expected = reference(**{key: value.to(self.device) for key, value in inputs.items()})
+        outputs = self._forward(self._to_device(inputs))
+        
+        # Compare sigmoid scores rather than logits, whose masked tokens are -inf
+        box_diff = (outputs.pred_boxes - expected.pred_boxes.float()).abs().max().item()
+        score_diff = (outputs.logits.sigmoid() - expected.logits.float().sigmoid()).abs().max().item()
+        if max(box_diff, score_diff) > HALF_WEIGHTS_TOLERANCE:
+            print(f"Half precision weights differ from FP32 by {max(box_diff, score_diff):.4f}, "
+                  f"more than {HALF_WEIGHTS_TOLERANCE}; using FP32 weights")
+            return False
+        
+        print(f"Half precision weights match FP32 within {HALF_WEIGHTS_TOLERANCE} "
+              f"(boxes {box_diff:.4f}, scores {score_diff:.4f})")
+        return True
+    
+    def compile(self, mode="reduce-overhead"):
+        """
+        Compile the model with torch.compile to fuse kernels and cut launch overhead.
+        
+        Args:
+            mode (str): torch.compile mode.
+            
+        Returns:
+            bool: True if the model was compiled, False if it keeps running eagerly.
+        """
+        if self.model is None or not hasattr(torch, "compile") or self._eager_model is not None:
+            return False
+        
+        try:
+            compiled_model = torch.compile(self.model, mode=mode, fullgraph=False)
+        except Exception as e:
+            print(f"torch.compile failed, using eager model: {e}")
+            return False
+        
+        self._eager_model = self.model
+        self.model = compiled_model
+        return True
     
-    def predict_image(self, image, text_prompt, box_threshold=0.35, text_threshold=0.25):
+    def _to_device(self, inputs):
         """
-        Run prediction on an image with the given text prompt.
+        Move processor outputs to the model device. On CUDA the tensors are staged in pinned
+        host memory and copied asynchronously on a dedicated stream, which the compute stream
+        then waits on, instead of stalling on pageable memory; floating point inputs such as
+        pixel_values are converted to the dtype of the weights.
+        
+        Args:
+            inputs (BatchFeature): Processor outputs on the CPU.
+            
+        Returns:
+            BatchFeature: The same inputs, now on the model device.
+        """
+        if self.onnx_session is not None:
+            return inputs
+        
+        if not self.use_cuda:
+            return inputs.to(self.device)
+        
+        compute_stream = torch.cuda.current_stream(self.device)
+        self.copy_stream.wait_stream(compute_stream)
+        with torch.cuda.stream(self.copy_stream):
+            for key, value in inputs.items():
+                if torch.is_tensor(value):
+                    dtype = self.model_dtype if value.is_floating_point() else None
+                    inputs[key] = value.pin_memory().to(self.device, dtype=dtype, non_blocking=True)
+        
+        # Order the compute stream after the copies and keep the copied memory alive until it is used there
+        compute_stream.wait_stream(self.copy_stream)
+        for value in inputs.values():
+            if torch.is_tensor(value):
+                value.record_stream(compute_stream)
+        return inputs
+    
+    def _parse_prompt(self, text_prompt):
+        """
+        Split a comma-separated prompt into stripped labels, parsing each prompt only once.
+        
+        Args:
+            text_prompt (str): Comma-separated list of objects to detect.
+            
+        Returns:
+            list: The labels of the prompt.
+        """
+        with self._cache_lock:
+            labels = self._prompt_cache.get(text_prompt)
+            if labels is not None:
+                self._prompt_cache.move_to_end(text_prompt)
+                return labels
+            
+            labels = [label.strip() for label in text_prompt.split(",")]
+            self._prompt_cache[text_prompt] = labels
+            if len(self._prompt_cache) > PROMPT_CACHE_SIZE:
+                self._prompt_cache.popitem(last=False)
+            return labels
+    
+    def encode_text(self, text_prompt):
+        """
+        Tokenize a text prompt once so it can be reused for every image it is applied to.
+        Results are memoized for the PROMPT_CACHE_SIZE most recent prompts, so repeated
+        calls return the same tensors.
+        
+        Args:
+            text_prompt (str or list): Comma-separated list of objects to detect, or a list of
+                such prompts to tokenize together, padded to a common length.
+            
+        Returns:
+            dict: Tokenized prompt tensors (input_ids, attention_mask, ...) on the model device,
+                with one row per prompt, padded to the next length in TEXT_BUCKETS.
+        """
+        text_prompts = (text_prompt,) if isinstance(text_prompt, str) else tuple(text_prompt)
+        with self._cache_lock:
+            text_cache = self._tokenized_cache.get(text_prompts)
+            if text_cache is not None:
+                self._tokenized_cache.move_to_end(text_prompts)
+                return text_cache
+        
+        text_labels = [self._parse_prompt(prompt) for prompt in text_prompts]
+        encoding = self.processor(text=text_labels, return_tensors="pt", padding=True)
+        
+        # Pad to a bucket length so the compiled model is not recaptured for every prompt length;
+        # padded tokens are masked out by the attention mask, so detections are unchanged
+        length = encoding["input_ids"].shape[1]
+        bucket = next((size for size in TEXT_BUCKETS if size >= length), length)
+        if bucket > length:
+            pad_token_id = self.processor.tokenizer.pad_token_id or 0
+            for key, value in encoding.items():
+                if torch.is_tensor(value):
+                    fill = pad_token_id if key == "input_ids" else 0
+                    encoding[key] = torch.nn.functional.pad(value, (0, bucket - length), value=fill)
+        
+        text_cache = dict(self._to_device(encoding))
+        with self._cache_lock:
+            self._tokenized_cache[text_prompts] = text_cache
+            if len(self._tokenized_cache) > PROMPT_CACHE_SIZE:
+                self._tokenized_cache.popitem(last=False)
+        return text_cache
+    
+    def _single_image_inputs(self, image):
+        """
+        Preprocess a single image, reusing the device tensors if the same image object was
+        preprocessed recently, e.g. when it is queried again with another prompt. Images are
+        assumed not to be modified in place between calls.
+        
+        Args:
+            image (PIL.Image): The input image.
+            
+        Returns:
+            dict: Image inputs (pixel_values, pixel_mask) on the model device.
+        """
+        key = id(image)
+        with self._cache_lock:
+            entry = self._image_cache.get(key)
+            if entry is not None and entry[0] is image:
+                self._image_cache.move_to_end(key)
+                return entry[1]
+        
+        # Preprocess outside the lock so other threads are not held up by it
+        image_inputs = dict(self._to_device(self.processor.image_processor([image], return_tensors="pt")))
+        with self._cache_lock:
+            self._image_cache[key] = (image, image_inputs)
+            if len(self._image_cache) > IMAGE_CACHE_SIZE:
+                self._image_cache.popitem(last=False)
+        return image_inputs
+    
+    def _prepare_inputs(self, images, text_cache, image_inputs=None):
+        """
+        Preprocess images and pair them with an already tokenized prompt.
+        
+        Args:
+            images (list): List of PIL.Image input images.
+            text_cache (dict): Output of encode_text for one prompt, or for one prompt per image.
+            image_inputs (dict, optional): Already preprocessed image inputs for the images.
+            
+        Returns:
+            dict: Model inputs on the model device.
+        """
+        # The image processor pads images to a common size and returns a pixel mask
+        if image_inputs is not None:
+            inputs = dict(image_inputs)
+        else:
+            inputs = dict(self._to_device(self.processor.image_processor(images, return_tensors="pt")))
+        
+        # Repeat a single tokenized prompt for every image in the batch
+        for key, value in text_cache.items():
+            inputs[key] = value.repeat(len(images), 1) if len(value) == 1 and len(images) > 1 else value
+        return inputs
+    
+    def _forward(self, inputs):
+        """
+        Run the model forward pass without autograd and with BF16/FP16 autocast on CUDA,
+        reverting to the eager model if the compiled one fails.
+        
+        Args:
+            inputs (dict): Preprocessed model inputs.
+        """
+        if self.onnx_session is not None:
+            return self._forward_onnx(inputs)
+        
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=self.autocast_dtype, enabled=self.use_cuda):
+            try:
+                outputs = self.model(**inputs)
+            except Exception as e:
+                if self._eager_model is None:
+                    raise
+                print(f"Compiled model failed, falling back to eager mode: {e}")
+                self.model, self._eager_model = self._eager_model, None
+                outputs = self.model(**inputs)
+            
+            # Post-process in FP32; NumPy has no BF16 type to convert the scores to
+            outputs.logits = outputs.logits.float()
+            outputs.pred_boxes = outputs.pred_boxes.float()
+            return outputs
+    
+    def _forward_onnx(self, inputs):
+        """
+        Run the exported model with ONNX Runtime in a single session call, computing the text
+        position ids and self-attention masks it takes as inputs on the host.
+        
+        Args:
+            inputs (dict): Preprocessed model inputs on the host.
+            
+        Returns:
+            SimpleNamespace: logits and pred_boxes tensors, as read by the processor's post-processing.
+        """
+        inputs = dict(inputs, **onnx_text_inputs(inputs["input_ids"]))
+        feed = {name: inputs[name].numpy() for name in self.onnx_input_names}
+        logits, pred_boxes = self.onnx_session.run(["logits", "pred_boxes"], feed)
+        return SimpleNamespace(logits=torch.from_numpy(logits), pred_boxes=torch.from_numpy(pred_boxes))
+    
+    def predict_image(self, image, text_prompt, box_threshold=0.35, text_threshold=0.25, text_cache=None):
+        """
+        Run prediction on an image with the given text prompt. The tokenized prompt is padded
+        to a fixed bucket length (see encode_text), so prompts of similar length reuse the same
+        compiled graph.
         
         Args:
             image (PIL.Image): The input image.
             text_prompt (str): Comma-separated list of objects to detect.
             box_threshold (float): Confidence threshold for bounding boxes.
             text_threshold (float): Confidence threshold for text labels.
+            text_cache (dict, optional): Output of encode_text for text_prompt, to skip
+                tokenizing the prompt again.
             
         Returns:
             tuple: (boxes, scores, labels) where boxes are in [x1, y1, x2, y2] format.
         """
-        # Prepare text labels
-        text_labels = [[label.strip() for label in text_prompt.split(",")]]
+        # Tokenize the prompt unless it was already encoded
+        if text_cache is None:
+            text_cache = self.encode_text(text_prompt)
         
-        # Prepare inputs
-        inputs = self.processor(images=image, text=text_labels, return_tensors="pt").to(self.device)
+        # Prepare inputs, reusing the preprocessed image if it was queried recently
+        inputs = self._prepare_inputs([image], text_cache, self._single_image_inputs(image))
         
         # Run inference
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+        outputs = self._forward(inputs)
         
         # Post-process results
         results = self.processor.post_process_grounded_object_detection(
             outputs,
-            inputs.input_ids,
+            inputs["input_ids"],
             box_threshold=box_threshold,
             text_threshold=text_threshold,
             target_sizes=[image.size[::-1]]
@@ -55,4 +464,44 @@ class GroundingDINOPredictor:
         scores = result["scores"]
         labels = result["labels"]
         
-        return boxes, scores, labels
\ No newline at end of file
+        return boxes, scores, labels
+    
+    def predict_batch(self, images, text_prompt, box_threshold=0.35, text_threshold=0.25, text_cache=None):
+        """
+        Run prediction on a batch of images in a single forward pass.
+        
+        Args:
+            images (list): List of PIL.Image input images.
+            text_prompt (str or list): Comma-separated list of objects to detect, shared by all
+                images, or a list with one such prompt per image.
+            box_threshold (float): Confidence threshold for bounding boxes.
+            text_threshold (float): Confidence threshold for text labels.
+            text_cache (dict, optional): Output of encode_text for text_prompt, to skip
+                tokenizing the prompt again.
+            
+        Returns:
+            list: One (boxes, scores, labels) tuple per image, boxes in [x1, y1, x2, y2] format.
+        """
+        if not isinstance(text_prompt, str) and len(text_prompt) != len(images):
+            raise ValueError(f"Got {len(text_prompt)} prompts for {len(images)} images")
+        
+        # Tokenize the prompt unless it was already encoded
+        if text_cache is None:
+            text_cache = self.encode_text(text_prompt)
+        
+        # Prepare inputs
+        inputs = self._prepare_inputs(images, text_cache)
+        
+        # Run inference
+        outputs = self._forward(inputs)
+        
+        # Post-process results
+        results = self.processor.post_process_grounded_object_detection(
+            outputs,
+            inputs["input_ids"],
+            box_threshold=box_threshold,
+            text_threshold=text_threshold,
+            target_sizes=[image.size[::-1] for image in images]
+        )
+        
+        return [(result["boxes"], result["scores"], result["labels"]) for result in results]
\ No newline at end of file
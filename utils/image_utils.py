@@ -0,0 +1,92 @@
+import os
+from collections import deque
+from itertools import islice
+from PIL import Image
+
+# torchvision decodes JPEG/PNG with libjpeg-turbo/libpng and releases the GIL while doing so,
+# which lets loader threads decode in parallel; other formats fall back to PIL
+try:
+    from torchvision.io import ImageReadMode, read_image
+except ImportError:
+    read_image = None
+
+# Supported image file extensions
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".bmp"})
+
+def list_image_files(directory):
+    """
+    List the image files directly inside a directory.
+    
+    Args:
+        directory (str): Directory to scan.
+        
+    Returns:
+        list: Sorted paths of files with a supported image extension.
+    """
+    with os.scandir(directory) as entries:
+        image_files = [
+            entry.path for entry in entries
+            if entry.is_file(follow_symlinks=False) and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+    return sorted(image_files)
+
+def chunked(iterable, size):
+    """
+    Yield successive lists of at most `size` items from an iterable.
+    
+    Args:
+        iterable (iterable): Items to split into chunks.
+        size (int): Maximum number of items per chunk.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def load_image(image_path):
+    """
+    Load and decode an image as RGB, returning None if it cannot be read.
+    
+    Args:
+        image_path (str): Path to the image file.
+        
+    Returns:
+        PIL.Image: The decoded image, or None on failure.
+    """
+    if read_image is not None:
+        try:
+            return Image.fromarray(read_image(image_path, ImageReadMode.RGB).permute(1, 2, 0).numpy())
+        except Exception:
+            pass
+    
+    try:
+        return Image.open(image_path).convert("RGB")
+    except Exception as e:
+        print(f"Error loading {image_path}: {str(e)}")
+        return None
+
+def prefetch_batches(executor, batches, depth=2, load_fn=load_image):
+    """
+    Yield decoded batches while the next `depth` batches are decoded in the background.
+    
+    Args:
+        executor (ThreadPoolExecutor): Pool used to decode images.
+        batches (iterable): Iterable of lists of image paths.
+        depth (int): Number of batches to keep in flight ahead of the consumer.
+        load_fn (callable): Function decoding one image path, returning None on failure.
+        
+    Yields:
+        tuple: (paths, images) where images holds the decoded image or None per path.
+    """
+    pending = deque()
+    for batch_paths in batches:
+        pending.append((batch_paths, [executor.submit(load_fn, path) for path in batch_paths]))
+        if len(pending) > depth:
+            paths, futures = pending.popleft()
+            yield paths, [future.result() for future in futures]
+    
+    while pending:
+        paths, futures = pending.popleft()
+        yield paths, [future.result() for future in futures]
\ No newline at end of file
@@ -1,6 +1,28 @@
 import cv2
 import numpy as np
-import random
+import hashlib
+import functools
+from collections import defaultdict
+from PIL import Image
+
+def image_to_array(image):
+    """
+    Get a numpy view of a PIL image, converting it only once per image object.
+    
+    The array is cached on the image and shared between callers, so it must be treated as
+    read-only; drawing functions copy it before modifying.
+    
+    Args:
+        image (PIL.Image): The image to convert.
+        
+    Returns:
+        numpy.ndarray: The image pixels.
+    """
+    array = getattr(image, "_np_array", None)
+    if array is None:
+        array = np.asarray(image)
+        image._np_array = array
+    return array
 
 # Generate a list of distinct colors for visualization
 def generate_colors(n):
@@ -13,46 +35,33 @@ def generate_colors(n):
     Returns:
         list: List of (B, G, R) color tuples.
     """
-    colors = []
-    for i in range(n):
-        # Use HSV color space to generate distinct colors
-        hue = i / n
-        saturation = 0.9
-        value = 0.9
-        
-        # Convert HSV to RGB
-        h = hue * 360
-        s = saturation
-        v = value
-        
-        c = v * s
-        x = c * (1 - abs((h / 60) % 2 - 1))
-        m = v - c
-        
-        if h < 60:
-            r, g, b = c, x, 0
-        elif h < 120:
-            r, g, b = x, c, 0
-        elif h < 180:
-            r, g, b = 0, c, x
-        elif h < 240:
-            r, g, b = 0, x, c
-        elif h < 300:
-            r, g, b = x, 0, c
-        else:
-            r, g, b = c, 0, x
-        
-        r, g, b = int((r + m) * 255), int((g + m) * 255), int((b + m) * 255)
-        colors.append((b, g, r))  # OpenCV uses BGR
+    # Use HSV color space to generate distinct colors, converting all hues to RGB at once
+    h = np.arange(n) / n * 360
+    s = 0.9
+    v = 0.9
+    
+    c = v * s
+    x = c * (1 - np.abs((h / 60) % 2 - 1))
+    m = v - c
     
-    return colors
+    # Pick the channel values of each hue's sextant
+    sextants = [h < 60, h < 120, h < 180, h < 240, h < 300]
+    r = np.select(sextants, [c, x, 0, 0, x], default=c)
+    g = np.select(sextants, [x, c, c, x, 0], default=0)
+    b = np.select(sextants, [0, 0, x, c, c], default=x)
+    
+    # Scale to 0-255, truncating like int(), and stack as BGR since OpenCV uses BGR
+    bgr = ((np.stack([b, g, r], axis=1) + m) * 255).astype(np.int32)
+    return [tuple(color) for color in bgr.tolist()]
 
-# Cache for label colors
-label_colors = {}
+# Fixed palette of evenly spaced hues that labels are mapped into
+_PALETTE = generate_colors(256)
 
+@functools.lru_cache(maxsize=4096)
 def get_color_for_label(label):
     """
-    Get a consistent color for a label.
+    Get a consistent color for a label, picked from the palette by a hash of the label so it
+    is the same across runs and processes. Results are memoized, so each label is hashed once.
     
     Args:
         label (str): The label to get a color for.
@@ -60,52 +69,68 @@ def get_color_for_label(label):
     Returns:
         tuple: (B, G, R) color tuple.
     """
-    global label_colors
-    
-    if label not in label_colors:
-        # Generate a random color for this label
-        color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-        label_colors[label] = color
+    # A one-byte digest indexes the 256-color palette; hash() is salted per process
+    digest = hashlib.blake2s(label.encode(), digest_size=1).digest()
+    return _PALETTE[digest[0]]
+
+@functools.lru_cache(maxsize=4096)
+def get_label_text_size(label_text, font_scale, thickness):
+    """
+    Get the size of a label text, measuring each text only once. There are only as many texts as
+    labels times two-decimal scores, so a bounded cache keeps nearly all of them.
     
-    return label_colors[label]
+    Args:
+        label_text (str): The full text drawn for the label, "label: score".
+        font_scale (float): Font scale for labels.
+        thickness (int): Line thickness of the text.
+        
+    Returns:
+        tuple: ((text_width, text_height), baseline) as returned by cv2.getTextSize.
+    """
+    return cv2.getTextSize(label_text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
 
-def draw_boxes_on_image(image, annotations, thickness=2, font_scale=0.6):
+def draw_boxes(image, boxes, labels, scores=None, thickness=2, font_scale=0.6, inplace=False):
     """
-    Draw bounding boxes and labels on an image.
+    Draw bounding boxes and labels given as arrays.
     
     Args:
         image (numpy.ndarray): The image to draw on.
-        annotations (list): List of annotation dictionaries with 'bbox', 'label', and 'score'.
+        boxes (array-like): (N, 4) array of [x1, y1, x2, y2] box coordinates.
+        labels (list): N object labels.
+        scores (array-like, optional): N confidence scores, 1.0 when omitted.
         thickness (int): Line thickness for bounding boxes.
         font_scale (float): Font scale for labels.
+        inplace (bool): Draw directly on image instead of a copy. Only pass True for a writable
+            buffer the caller owns, not for arrays shared through image_to_array.
         
     Returns:
         numpy.ndarray: Image with bounding boxes and labels drawn.
     """
-    # Make a copy of the image to avoid modifying the original
-    img_with_boxes = image.copy()
+    # Make a copy of the image to avoid modifying the original, unless the caller owns it
+    img_with_boxes = image if inplace else image.copy()
     
-    for ann in annotations:
-        # Get bounding box coordinates
-        x1, y1, x2, y2 = [int(coord) for coord in ann["bbox"]]
-        
-        # Get label and score
-        label = ann["label"]
-        score = ann.get("score", 1.0)
-        
-        # Get color for this label
-        color = get_color_for_label(label)
-        
-        # Draw bounding box
-        cv2.rectangle(img_with_boxes, (x1, y1), (x2, y2), color, thickness)
-        
+    # Convert all coordinates to integers in one cast (truncating like int())
+    boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+    if scores is None:
+        scores = [1.0] * len(boxes)
+    
+    # Get color for each label
+    colors = [get_color_for_label(label) for label in labels]
+    
+    # Draw bounding boxes as closed polylines through their corners, one call per color
+    corners = boxes[:, [[0, 1], [2, 1], [2, 3], [0, 3]]]
+    boxes_by_color = defaultdict(list)
+    for i, color in enumerate(colors):
+        boxes_by_color[color].append(i)
+    for color, indices in boxes_by_color.items():
+        cv2.polylines(img_with_boxes, list(corners[indices]), True, color, thickness)
+    
+    for (x1, y1, x2, y2), label, score, color in zip(boxes.tolist(), labels, scores, colors):
         # Prepare label text
         label_text = f"{label}: {score:.2f}"
         
         # Get text size
-        (text_width, text_height), baseline = cv2.getTextSize(
-            label_text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness
-        )
+        (text_width, text_height), baseline = get_label_text_size(label_text, font_scale, thickness)
         
         # Draw label background
         cv2.rectangle(
@@ -127,4 +152,39 @@ def draw_boxes_on_image(image, annotations, thickness=2, font_scale=0.6):
             thickness
         )
     
-    return img_with_boxes
\ No newline at end of file
+    return img_with_boxes
+
+def draw_boxes_on_image(image, annotations, thickness=2, font_scale=0.6, inplace=False):
+    """
+    Draw bounding boxes and labels on an image.
+    
+    Args:
+        image (numpy.ndarray): The image to draw on.
+        annotations (list): List of annotation dictionaries with 'bbox', 'label', and 'score'.
+        thickness (int): Line thickness for bounding boxes.
+        font_scale (float): Font scale for labels.
+        inplace (bool): Draw directly on image instead of a copy (see draw_boxes).
+        
+    Returns:
+        numpy.ndarray: Image with bounding boxes and labels drawn.
+    """
+    return draw_boxes(
+        image,
+        [ann["bbox"] for ann in annotations],
+        [ann["label"] for ann in annotations],
+        [ann.get("score", 1.0) for ann in annotations],
+        thickness=thickness,
+        font_scale=font_scale,
+        inplace=inplace
+    )
+
+def save_visualization(image, output_path, quality=85):
+    """
+    Encode an annotated image and write it straight to disk.
+    
+    Args:
+        image (numpy.ndarray): RGB image to save.
+        output_path (str): Destination file; the format is taken from its extension.
+        quality (int): JPEG quality, ignored for lossless formats.
+    """
+    Image.fromarray(image).save(output_path, quality=quality)
\ No newline at end of file